@@ -0,0 +1,944 @@
+##### Offline benchmarks and equivalence checks.
+##### These use a tiny randomly initialized model and synthetic events so they can be run anywhere without downloads:
+#####   python3 benchmark.py prefill
+#####   python3 benchmark.py events
+#####   python3 benchmark.py decode
+#####   python3 benchmark.py sample
+#####   python3 benchmark.py speculate
+#####   python3 benchmark.py startup
+#####   python3 benchmark.py quantize
+#####   python3 benchmark.py worker
+#####   python3 benchmark.py resume
+#####   python3 benchmark.py bot
+#####   python3 benchmark.py commands
+#####   python3 benchmark.py pool
+#####   python3 benchmark.py catchup
+
+import argparse, json, os, random, subprocess, sys, tempfile, time, types, urllib.parse
+
+import torch
+
+def tiny_model(path, n_layer = 2, n_embd = 64, vocab_size = 50277, seed = 0):
+    # writes a randomly initialized RWKV-4 checkpoint to path + '.pth' in the layout prwkv loads
+    generator = torch.Generator().manual_seed(seed)
+    def rand(*shape, scale = 0.1):
+        return torch.randn(*shape, generator=generator) * scale
+    def ln(prefix):
+        w[prefix + '.weight'] = 1 + rand(n_embd)
+        w[prefix + '.bias'] = rand(n_embd)
+    w = {}
+    w['emb.weight'] = rand(vocab_size, n_embd)
+    for i in range(n_layer):
+        block = f'blocks.{i}'
+        if i == 0:
+            ln(block + '.ln0')
+        ln(block + '.ln1')
+        ln(block + '.ln2')
+        for name in ('k', 'v', 'r'):
+            w[f'{block}.att.time_mix_{name}'] = torch.rand(1, 1, n_embd, generator=generator)
+        w[block + '.att.time_decay'] = rand(n_embd, scale = 1)
+        w[block + '.att.time_first'] = rand(n_embd, scale = 1)
+        for name in ('key', 'value', 'receptance', 'output'):
+            w[f'{block}.att.{name}.weight'] = rand(n_embd, n_embd)
+        for name in ('k', 'r'):
+            w[f'{block}.ffn.time_mix_{name}'] = torch.rand(1, 1, n_embd, generator=generator)
+        w[block + '.ffn.key.weight'] = rand(n_embd * 4, n_embd)
+        w[block + '.ffn.value.weight'] = rand(n_embd, n_embd * 4)
+        w[block + '.ffn.receptance.weight'] = rand(n_embd, n_embd)
+    ln('ln_out')
+    w['head.weight'] = rand(vocab_size, n_embd)
+    torch.save(w, path + '.pth')
+    return path
+
+def tiny_rwkv(dir, n_layer = 2, n_embd = 64, **kwparams):
+    import module_rwkv
+    path = tiny_model(os.path.join(dir, 'tiny'), n_layer, n_embd)
+    return module_rwkv.RWKVModel(path, os.path.join(dir, 'state--tiny'), n_layer, n_embd, 1024, **kwparams)
+
+def truncated_rwkv(dir, path, n_layer, n_embd, refine = 1.0):
+    # a model of the first n_layer blocks of the checkpoint at path, as a stand-in for a smaller model of the same family.
+    # the outputs of the later blocks in the original are scaled by refine, so that they only adjust what the first ones predict
+    # the way a trained larger model mostly agrees with a smaller one; random blocks at full scale share nothing.
+    import module_rwkv
+    w = torch.load(path + '.pth')
+    for key in list(w):
+        if key.startswith('blocks.') and int(key.split('.')[1]) >= n_layer and key.endswith(('att.output.weight', 'ffn.value.weight')):
+            w[key] = w[key] * refine
+    torch.save(w, path + '.pth')
+    w = {key: val for key, val in w.items() if not key.startswith('blocks.') or int(key.split('.')[1]) < n_layer}
+    torch.save(w, os.path.join(dir, 'draft.pth'))
+    return module_rwkv.RWKVModel(os.path.join(dir, 'draft'), os.path.join(dir, 'state--draft'), n_layer, n_embd, 1024)
+
+SAMPLE_TEXT = ''.join(
+    f'"user{idx % 3}", in "#room{idx % 2}", says: message number {idx} about the quick brown fox\n'
+    for idx in range(64)
+)
+
+def bench_prefill(args):
+    with tempfile.TemporaryDirectory() as dir:
+        rwkv = tiny_rwkv(dir, args.layers, args.embd)
+        input_ids = rwkv.tokenizer.encode(SAMPLE_TEXT).ids[:args.tokens]
+
+        # equivalence: the chunked path should reach the same state and logits as the per-token path
+        serial_logits, serial_state = rwkv._prefill_serial(input_ids, rwkv.state.clone())
+        for chunk_size in (1, 7, args.chunk):
+            logits, state = rwkv.prefill(input_ids, rwkv.state.clone(), chunk_size)
+            logit_err = (logits - serial_logits).abs().max().item()
+            state_err = (state - serial_state)[torch.isfinite(serial_state)].abs().max().item()
+            print(f'chunk={chunk_size}: max logit error {logit_err:.2e}, max state error {state_err:.2e}')
+            assert logit_err < args.tolerance and state_err < args.tolerance
+
+        # throughput
+        def timed(func):
+            start = time.perf_counter()
+            for _ in range(args.repeat):
+                func(input_ids, rwkv.state.clone())
+            return len(input_ids) * args.repeat / (time.perf_counter() - start)
+        serial = timed(rwkv._prefill_serial)
+        chunked = timed(lambda ids, state: rwkv.prefill(ids, state, args.chunk))
+        print(f'{len(input_ids)} tokens: per-token {serial:.1f} tok/s, chunked {chunked:.1f} tok/s ({chunked/serial:.2f}x)')
+
+def bench_decode(args):
+    with tempfile.TemporaryDirectory() as dir:
+        rwkv = tiny_rwkv(dir, args.layers, args.embd)
+        # each room starts from a different conversation
+        starts = []
+        for idx in range(max(args.batch)):
+            logits, state = rwkv.prefill(rwkv.tokenizer.encode(f'"user{idx}", in "#room{idx}", says: hello number {idx}\n').ids, rwkv._new_state())
+            starts.append((state, logits))
+
+        # equivalence: batched greedy decoding should pick the same tokens as decoding each room alone
+        for idx, (state, logits) in enumerate(starts[:4]):
+            state = state.clone()
+            alone = []
+            for step in range(args.check):
+                token_id = logits.argmax()
+                alone.append(int(token_id))
+                logits, state = rwkv.model.model.forward([token_id], state)
+            states = torch.stack([start[0] for start in starts[:4]])
+            logits = torch.stack([start[1] for start in starts[:4]])
+            batched = []
+            for step in range(args.check):
+                token_ids = logits.argmax(dim=-1)
+                batched.append(int(token_ids[idx]))
+                logits = rwkv._forward(token_ids[:, None], states)
+            assert alone == batched, (alone, batched)
+        print(f'batched greedy tokens match per-room decoding for {args.check} steps')
+
+        # throughput, one forward per step for the whole batch
+        print(f'per-token forward: {args.tokens / timed_serial(rwkv, starts[0], args.tokens):.1f} tok/s')
+        for batch in args.batch:
+            states = torch.stack([start[0] for start in starts[:batch]])
+            logits = torch.stack([start[1] for start in starts[:batch]])
+            start = time.perf_counter()
+            for step in range(args.tokens):
+                logits = rwkv._forward(logits.argmax(dim=-1)[:, None], states)
+            elapsed = time.perf_counter() - start
+            print(f'batch={batch}: {batch * args.tokens / elapsed:.1f} tok/s aggregate, {elapsed / args.tokens * 1000:.2f} ms/step')
+
+def timed_serial(rwkv, start, tokens):
+    state, logits = start[0].clone(), start[1]
+    begin = time.perf_counter()
+    for step in range(tokens):
+        logits, state = rwkv.model.model.forward([logits.argmax()], state)
+    return time.perf_counter() - begin
+
+def bench_sample(args):
+    import module_rwkv
+    generator = torch.Generator().manual_seed(0)
+    samplers = {
+        'argmax': None,
+        'greedy': module_rwkv.Sampler(),
+        'temperature': module_rwkv.Sampler(temperature=0.8, seed=0),
+        'top_k=40': module_rwkv.Sampler(temperature=0.8, top_k=40, seed=0),
+        'top_p=0.9': module_rwkv.Sampler(temperature=0.8, top_p=0.9, seed=0),
+        'top_k+top_p+penalty': module_rwkv.Sampler(temperature=0.8, top_k=40, top_p=0.9, repetition_penalty=1.2, seed=0),
+    }
+    for batch in args.batch:
+        logits = torch.randn(batch, args.vocab, generator=generator) * 4
+        recent = [list(range(row, row + 64)) for row in range(batch)]
+
+        # the greedy and narrowed samplers must agree with argmax
+        assert (module_rwkv.Sampler()(logits) == logits.argmax(dim=-1)).all()
+        assert (module_rwkv.Sampler(temperature=1, top_k=1)(logits) == logits.argmax(dim=-1)).all()
+        assert (module_rwkv.Sampler(temperature=1, top_p=1e-6)(logits) == logits.argmax(dim=-1)).all()
+
+        for name, sampler in samplers.items():
+            start = time.perf_counter()
+            for _ in range(args.repeat):
+                if sampler is None:
+                    logits.argmax(dim=-1)
+                else:
+                    sampler(logits, recent)
+            elapsed = (time.perf_counter() - start) / args.repeat
+            print(f'batch={batch} {name}: {elapsed * 1e6:.0f} us/step, {elapsed / batch * 1e6:.0f} us/token')
+
+def bench_speculate(args):
+    import module_rwkv
+    with tempfile.TemporaryDirectory() as dir:
+        draft = truncated_rwkv(dir, tiny_model(os.path.join(dir, 'tiny'), args.layers, args.embd), args.draft_layers, args.embd, args.refine)
+        rwkv = module_rwkv.RWKVModel(os.path.join(dir, 'tiny'), os.path.join(dir, 'state--tiny'), args.layers, args.embd, 1024, draft = draft, draft_tokens = args.draft_tokens)
+        sampler = module_rwkv.Sampler(stop=())
+        starts, keys = [], []
+        for idx in range(args.rooms):
+            rwkv.state_path = os.path.join(dir, f'state--tiny--room{idx}')
+            rwkv.model.init_state, rwkv.model.init_logits = rwkv._new_state(), None
+            rwkv.add(SAMPLE_TEXT.split('\n')[idx] + '\n')
+            starts.append(rwkv.snapshot())
+            keys.append(rwkv.state_path)
+        drafts = {key: state.clone() for key, state in rwkv.drafts.items()}
+        def timed(keys):
+            rwkv.drafts.update({key: state.clone() for key, state in drafts.items()})
+            texts = {}
+            start = time.perf_counter()
+            for index, text, end in rwkv.generate(starts, sampler, args.chars, keys):
+                texts[index] = text
+            return texts, time.perf_counter() - start
+        greedy, greedy_time = timed(None)
+        rwkv.speculation = True
+        speculative, speculative_time = timed(keys)
+        assert greedy == speculative, (greedy, speculative)
+        stats = rwkv.stats
+        print(f'speculative output matches greedy for {args.rooms} rooms of {args.chars} characters')
+        print(f'draft acceptance {stats["draft_accepted"] / stats["draft_proposed"]:.1%}, '
+              f'{stats["speculative_tokens"] / stats["speculative_steps"]:.2f} tokens per verifying pass per room')
+        print(f'greedy {greedy_time:.2f}s, speculative {speculative_time:.2f}s ({greedy_time / speculative_time:.2f}x)')
+        if args.rooms == 1:
+            # left to measure, the model drafts the replies of a single room only while that is faster
+            rwkv.speculation = None
+            for key in ('speculative_token_seconds', 'plain_token_seconds', 'speculative_replies', 'plain_replies'):
+                stats[key] = 0
+            adaptive_time = sum([timed(keys)[1] for idx in range(args.replies)])
+            print(f'measured {stats["speculative_token_seconds"] * 1000:.2f}ms per token drafting, {stats["plain_token_seconds"] * 1000:.2f}ms without; '
+                  f'{args.replies} replies drafted {stats["speculative_replies"]} times, {adaptive_time / args.replies:.2f}s each '
+                  f'({greedy_time * args.replies / adaptive_time:.2f}x greedy)')
+        rwkv.checkpoints.flush()
+
+STARTUP_SCRIPT = """
+import json, psutil, resource, sys, time
+start = time.perf_counter()
+import module_rwkv
+imported = time.perf_counter()
+module_rwkv._imports()
+imported_torch = time.perf_counter()
+base_rss = psutil.Process().memory_info().rss
+rwkv = module_rwkv.RWKVModel(sys.argv[1], sys.argv[2], int(sys.argv[3]), int(sys.argv[4]), 1024)
+loaded = time.perf_counter()
+loaded_rss = psutil.Process().memory_info().rss
+logits, state = rwkv.prefill(rwkv.tokenizer.encode('hello').ids, rwkv._new_state())
+print(json.dumps(dict(
+    imported = imported - start, imported_torch = imported_torch - imported, loaded = loaded - imported_torch,
+    forward = time.perf_counter() - loaded, base_rss = base_rss, loaded_rss = loaded_rss, rss = psutil.Process().memory_info().rss,
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024, logits = logits[:8].tolist(),
+)))
+"""
+
+def bench_startup(args):
+    with tempfile.TemporaryDirectory() as dir:
+        path = tiny_model(os.path.join(dir, 'tiny'), args.layers, args.embd)
+        size = os.path.getsize(path + '.pth')
+        def start():
+            result = subprocess.run(
+                [sys.executable, '-c', STARTUP_SCRIPT, path, os.path.join(dir, 'state--tiny'), str(args.layers), str(args.embd)],
+                capture_output=True, text=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__)),
+            )
+            return json.loads(result.stdout.strip().split('\n')[-1])
+        cold = start()
+        warm = [start() for _ in range(args.repeat)]
+        assert all([result['logits'] == cold['logits'] for result in warm])
+        print(f'{size / 2**20:.0f} MiB checkpoint, warm logits match cold')
+        for name, result in [('cold', cold)] + [('warm', result) for result in warm]:
+            print(f'{name}: import module_rwkv {result["imported"]:.2f}s, torch and prwkv {result["imported_torch"]:.2f}s, '
+                  f'load {result["loaded"]:.2f}s, first prefill {result["forward"]:.2f}s, '
+                  f'rss over imports {(result["loaded_rss"] - result["base_rss"]) / 2**20:.0f} MiB loaded, '
+                  f'{(result["rss"] - result["base_rss"]) / 2**20:.0f} MiB after prefill, peak rss {result["max_rss"] / 2**20:.0f} MiB')
+
+def bench_quantize(args):
+    import module_rwkv
+    with tempfile.TemporaryDirectory() as dir:
+        path = tiny_model(os.path.join(dir, 'tiny'), args.layers, args.embd)
+        models = {
+            'float': module_rwkv.RWKVModel(path, os.path.join(dir, 'state--float'), args.layers, args.embd, 1024),
+            'int8': module_rwkv.RWKVModel(path, os.path.join(dir, 'state--int8'), args.layers, args.embd, 1024, quantize = True),
+        }
+        # quality: logits at every position of a fixed prompt
+        input_ids = models['float'].tokenizer.encode(SAMPLE_TEXT).ids[:args.tokens]
+        logits = {
+            name: rwkv._forward([input_ids], rwkv._new_state()[None], trace = True)[0][0]
+            for name, rwkv in models.items()
+        }
+        error = (logits['int8'] - logits['float']).abs()
+        agree = logits['int8'].argmax(dim=-1) == logits['float'].argmax(dim=-1)
+        # random weights give many near ties, so agreement is also shown where the float model's top token leads by over 1
+        top = logits['float'].topk(2, dim=-1).values
+        confident = top[:, 0] - top[:, 1] > 1
+        cosine = torch.nn.functional.cosine_similarity(logits['int8'], logits['float'], dim=-1).min().item()
+        print(f'{len(input_ids)} prompt positions: max logit error {error.max().item():.3f}, mean {error.mean().item():.4f}, min cosine similarity {cosine:.5f}')
+        print(f'top-1 agreement {agree.float().mean().item():.1%}, {agree[confident].float().mean().item():.1%} of {confident.sum().item()} confident positions')
+        assert cosine >= args.cosine
+
+        # a second load maps the int8 matrices from the converted cache, and runs the same
+        cached = module_rwkv.RWKVModel(path, os.path.join(dir, 'state--cached'), args.layers, args.embd, 1024, quantize = True)
+        assert os.path.exists(module_rwkv.converted_path(path, 'fp32', quantize = True))
+        assert torch.equal(cached._forward([input_ids], cached._new_state()[None], trace = True)[0][0], logits['int8'])
+        print('int8 weights loaded from the converted cache give the same logits')
+        for quantize in (False, True):
+            rwkv = module_rwkv.RWKV.__new__(module_rwkv.RWKV)
+            rwkv.memory_bound, rwkv.quantize, rwkv.speculative = args.bound, quantize, False
+            print(f'largest model under {args.bound / 2**30:.1f} GiB{" with quantize" if quantize else ""}: {rwkv._largest()}')
+
+        for name, rwkv in models.items():
+            w = rwkv.model.model.w
+            weights = [w.head.weight] + [
+                linear.weight
+                for block in w.blocks.values()
+                for linear in (block.att.key, block.att.value, block.att.receptance, block.att.output, block.ffn.key, block.ffn.value, block.ffn.receptance)
+            ]
+            size = sum([weight.nbytes if type(weight) is module_rwkv.Int8Weight else weight.nelement() * weight.element_size() for weight in weights])
+            state = rwkv._new_state()[None]
+            token_ids = torch.tensor([[input_ids[0]]])
+            start = time.perf_counter()
+            for step in range(args.steps):
+                token_ids = rwkv._forward(token_ids, state).argmax(dim=-1)[:, None]
+            elapsed = time.perf_counter() - start
+            print(f'{name}: matrices {size / 2**20:.0f} MiB, decode {args.steps / elapsed:.1f} tok/s')
+
+def recorded_events(count, rooms = 4, seed = 0):
+    # a synthetic stand-in for a recorded sync stream, in the shape matrix sends events
+    rng = random.Random(seed)
+    events = []
+    for idx in range(count):
+        room_id = f'!room{rng.randrange(rooms)}:localhost'
+        kind = rng.random()
+        if kind < 0.6:
+            content = {'msgtype': 'm.text', 'body': f'message {idx} :thumbs_up: ' + 'text ' * rng.randrange(1, 40)}
+            etype = 'm.room.message'
+        elif kind < 0.75:
+            content = {'m.relates_to': {'event_id': f'${idx - 1}', 'key': '👍', 'rel_type': 'm.annotation'}}
+            etype = 'm.reaction'
+        elif kind < 0.85:
+            content = {'membership': 'join', 'displayname': f'user{idx}'}
+            etype = 'm.room.member'
+        else:
+            content = {'receipts': {f'${idx - 1}': {'ts': idx}}}
+            etype = 'm.receipt.custom'
+        events.append(dict(event_id=f'${idx}', room_id=room_id, sender=f'@user{idx % 7}:localhost', type=etype, content=content, origin_server_ts=idx))
+    return events
+
+def bench_events(args):
+    import service_matrix
+    if args.recording:
+        with open(args.recording) as recording:
+            events = json.load(recording)
+    else:
+        events = recorded_events(args.count)
+    service = service_matrix.Matrix.__new__(service_matrix.Matrix)
+    service.rooms = {}
+    rooms = {
+        room_id: types.SimpleNamespace(room_id=room_id, name=None, guest_access=False, events=[])
+        for room_id in set([event['room_id'] for event in events])
+    }
+    def timed(touch):
+        start = time.perf_counter()
+        for event_raw in events:
+            event = service._matrix2event(rooms[event_raw['room_id']], event_raw)
+            if touch:
+                event.data, event.reply
+        return len(events) / (time.perf_counter() - start)
+    print(f'{len(events)} events: {timed(False):.0f} events/s dispatched undecoded, {timed(True):.0f} events/s fully decoded')
+
+def bench_worker(args):
+    import module_rwkv, inference_worker, signal
+    with tempfile.TemporaryDirectory() as dir:
+        local = tiny_rwkv(dir, args.layers, args.embd)
+        remote = inference_worker.RemoteModel(os.path.join(dir, 'tiny'), os.path.join(dir, 'state--remote'), n_layer = args.layers, n_embd = args.embd, ctx_len = 1024)
+        sampler = module_rwkv.Sampler(stop=())
+        lines = SAMPLE_TEXT.split('\n')
+        def timed(func, *params):
+            start = time.perf_counter()
+            for _ in range(args.repeat):
+                result = func(*params)
+            return result, (time.perf_counter() - start) / args.repeat
+
+        # round trip of an empty request
+        remote.ping()
+        result, ping = timed(remote.ping)
+        print(f'ping round trip {ping * 1e6:.0f} us')
+
+        # equivalence and overhead: the same messages added to both should reach the same state
+        for rwkv in (local, remote):
+            rwkv.model.init_state, rwkv.model.init_logits = rwkv.model.init_state.clone(), None
+        for idx in range(args.messages):
+            part = [module_rwkv.Template(lines[idx].split(':')[0] + ':'), lines[idx].split(':', 1)[1] + '\n']
+            local_state = local.model.init_state.clone()
+            remote_state = remote.model.init_state.clone()
+            result, local_time = timed(lambda: local.add(part, local_state.clone()))
+            result, remote_time = timed(lambda: remote.add(part, remote_state.clone()))
+            error = (local.state - remote.state).abs().max().item()
+            assert error == 0 and torch.equal(local.model.init_logits, remote.model.init_logits), error
+            if idx == 0:
+                print(f'add: in-process {local_time * 1000:.2f} ms, worker {remote_time * 1000:.2f} ms, overhead {(remote_time - local_time) * 1000:.2f} ms')
+        print(f'worker states match in-process states after {args.messages} messages')
+
+        def generate(rwkv):
+            start = time.perf_counter()
+            first = None
+            for index, text, end in rwkv.generate([rwkv.snapshot()], sampler, args.chars):
+                first = first or time.perf_counter() - start
+            return text, first, time.perf_counter() - start
+        local_text, local_first, local_time = generate(local)
+        remote_text, remote_first, remote_time = generate(remote)
+        assert local_text == remote_text, (local_text, remote_text)
+        print(f'generate {args.chars} characters: in-process first text {local_first * 1000:.1f} ms, total {local_time * 1000:.1f} ms; '
+              f'worker first text {remote_first * 1000:.1f} ms, total {remote_time * 1000:.1f} ms')
+
+        # a generation dropped after its first text leaves nothing behind for the next request to read
+        for index, text, end in remote.generate([remote.snapshot()], sampler, args.chars):
+            break
+        assert remote.ping() is None and generate(remote)[0] == local_text
+        print('abandoned generation drained, the next request got its own reply')
+
+        # a killed worker is restarted on the next request, and the states it was given are intact
+        state = remote.state.clone()
+        os.kill(remote.process.pid, signal.SIGKILL)
+        remote.process.join()
+        start = time.perf_counter()
+        remote.add(lines[args.messages] + '\n')
+        restart = time.perf_counter() - start
+        local.add(lines[args.messages] + '\n')
+        assert torch.equal(local.state, remote.state) and not torch.equal(state, remote.state)
+        print(f'killed worker restarted and the request retried in {restart:.2f}s, state continued from before the kill')
+        remote.__exit__(None, None, None)
+        local.checkpoints.flush()
+        print(f'worker requests {remote.stats["requests"]}, restarts {remote.stats["restarts"]}')
+
+def bench_resume(args):
+    import fake_homeserver, service_matrix, service_matrix_async
+    def connect(server, sync_path):
+        handler = types.SimpleNamespace(_on_event=lambda event: None)
+        start = time.perf_counter()
+        syncs = server.requests['sync']
+        if args.asyncio:
+            service = service_matrix_async.AsyncMatrix(handler, 'test_matrix_bot', 'password', server.url, sync_path = sync_path)
+        else:
+            service = service_matrix.Matrix(handler, 'test_matrix_bot', 'password', server.url, sync_path = sync_path)
+        return service, time.perf_counter() - start, server.requests['sync'] - syncs
+    def history(service):
+        return [event.id for room in service.rooms.values() for event in room.history]
+    for rooms in args.rooms:
+        server = fake_homeserver.FakeHomeserver().start()
+        room_ids = [server.add_room(f'!room{idx}:localhost', f'room{idx}') for idx in range(rooms)]
+        for idx in range(args.history):
+            for room_id in room_ids:
+                server.post(room_id, '@user:localhost', f'message {idx}')
+        with tempfile.TemporaryDirectory() as dir:
+            sync_path = os.path.join(dir, 'sync--test_matrix_bot.json')
+            # first start: a full sync, after which every room is processed.
+            # rooms are confirmed through the sync state, as the read markers service.confirm sends would outlive the server.
+            service, full_time, full_syncs = connect(server, sync_path)
+            for room in service.rooms.values():
+                service.sync_state.confirm(room.history[-1])
+            service.stop()
+
+            # new messages in a few rooms; a restart should see only those
+            new = [server.post(room_id, '@user:localhost', 'new message') for room_id in room_ids[:args.new]]
+            service, resume_time, resume_syncs = connect(server, sync_path)
+            assert sorted(history(service)) == sorted(new), (len(history(service)), len(new))
+            # rooms without new messages are still there, to be greeted and caught up
+            assert len(service.rooms) == rooms, len(service.rooms)
+
+            # the first of them is left unprocessed, so it should be delivered again after another restart.
+            # others from the same sync batch come again too, but are before their room's resume point.
+            for room in service.rooms.values():
+                if len(room.history) and room.history[-1].id != new[0]:
+                    service.sync_state.confirm(room.history[-1])
+            service.stop()
+            service, again_time, again_syncs = connect(server, sync_path)
+            pending = [event.id for room in service.rooms.values() for event in room.history.after(service.sync_state.resume.get(room.name))]
+            assert pending == [new[0]], pending
+            service.stop()
+        server.stop()
+        print(f'{rooms} rooms of {args.history} messages: full sync startup {full_time * 1000:.0f} ms, '
+              f'resumed startup with {args.new} new messages {resume_time * 1000:.0f} ms, '
+              f'{full_syncs + resume_syncs + again_syncs} sync requests, unprocessed message delivered again')
+
+def bench_commands(args):
+    # the command table against ordinary chat, and !eval in the sandbox including one that has to be stopped
+    import threading
+    import module_commands
+    class Room:
+        def __init__(self):
+            self.sent = []
+            self.event = threading.Event()
+        def send(self, text):
+            self.sent.append((time.perf_counter(), text))
+            self.event.set()
+    service = types.SimpleNamespace(user_id='@bot:localhost', rooms={})
+    commands = module_commands.Commands(types.SimpleNamespace(services=[service]), args.workers, args.timeout)
+    room = Room()
+    def message(data):
+        return types.SimpleNamespace(sender='@user:localhost', service=service, type='message', data=data, room=room)
+    try:
+        lines = [message(line.split(': ', 1)[1]) for line in SAMPLE_TEXT.split('\n') if line]
+        start = time.perf_counter()
+        for idx in range(args.repeat):
+            for msg in lines:
+                assert not commands.on_message(msg)
+        elapsed = time.perf_counter() - start
+        print(f'{len(lines) * args.repeat} chat messages: {elapsed / len(lines) / args.repeat * 1e6:.2f}us each to find they are not commands')
+        for data, expected in (('!echo hello there', 'hello there'), ('!d1', 'dice must be between 1 and 1000!'), ('!d x', 'x is not a positive number!')):
+            commands.on_message(message(data))
+            assert room.sent[-1][1] == expected, room.sent[-1]
+        def evaluate(expression, timeout):
+            room.event.clear()
+            start = time.perf_counter()
+            commands.on_message(message('!eval ' + expression))
+            returned = time.perf_counter() - start
+            assert room.event.wait(timeout), f'no answer to {expression}'
+            return returned, room.sent[-1][0] - start, room.sent[-1][1]
+        # the workers start in the background, importing this module; the first answer waits for them
+        returned, answered, text = evaluate('1', 60)
+        print(f'!eval while the sandbox starts: answered after {answered:.2f}s')
+        latencies = []
+        for idx in range(args.evals):
+            returned, answered, text = evaluate(f'{idx} * 2', args.timeout * 2)
+            assert text == str(idx * 2), text
+            latencies.append(answered)
+        print(f'!eval {args.evals} times: ' + ', '.join([f'{name} {value:.2f}ms' for name, value in percentiles(latencies).items()]))
+        returned, answered, text = evaluate('sum(range(10**12))', args.timeout * 4)
+        print(f'!eval sum(range(10**12)): on_message returned in {returned * 1000:.2f}ms, answered "{text}" after {answered:.2f}s')
+        assert 'timed out' in text or 'cpu' in text, text
+        returned, answered, text = evaluate('[1] * 10**9', args.timeout * 4)
+        print(f'!eval [1] * 10**9: answered "{text}" after {answered * 1000:.1f}ms')
+        returned, answered, text = evaluate("__import__('os').getpid()", args.timeout * 2)
+        assert 'not allowed' in text, text
+        returned, answered, text = evaluate("open('/etc/passwd').read()", args.timeout * 2)
+        assert 'NameError' in text, text
+        print('!eval refuses __import__ and open')
+        returned, answered, text = evaluate('6 * 7', args.timeout * 2)
+        assert text == '42', text
+        print(f'!eval after those: answered "{text}" after {answered * 1000:.1f}ms')
+        print('sandbox', commands.sandbox.stats)
+    finally:
+        commands.sandbox.stop()
+
+def percentiles(values, points = (50, 90, 99)):
+    # nearest-rank percentiles and the maximum of values, in milliseconds
+    values = sorted(values)
+    if not values:
+        return {}
+    result = {f'p{point}': values[min(len(values) - 1, int(len(values) * point / 100))] * 1000 for point in points}
+    result['max'] = values[-1] * 1000
+    return result
+
+def await_reply(server, room_id, msg_id, position, timeout):
+    # waits for the bot to finish replying to msg_id, returning the times of its first message and of its thinking reaction's removal.
+    # position is the length of the server's timeline before msg_id was posted.
+    first = reaction = None
+    deadline = time.monotonic() + timeout
+    with server.condition:
+        while True:
+            for event_room_id, event in server.timeline[position:]:
+                position += 1
+                if event_room_id != room_id or event['sender'] != server.user_id:
+                    continue
+                relates = event['content'].get('m.relates_to', {})
+                if event['type'] == 'm.room.message' and first is None and 'm.new_content' not in event['content']:
+                    first = time.perf_counter()
+                elif event['type'] == 'm.reaction' and relates.get('event_id') == msg_id:
+                    reaction = event['event_id']
+                elif event['type'] == 'm.room.redaction' and reaction is not None and event.get('redacts') == reaction:
+                    return first, time.perf_counter()
+            if time.monotonic() > deadline:
+                raise TimeoutError(f'no reply to {msg_id} in {room_id}')
+            server.condition.wait(deadline - time.monotonic())
+
+def bench_bot(args):
+    # the whole bot against a fake homeserver: scripted messages in several rooms, answered by a tiny model
+    import contextlib
+    # progress and checkpoint messages go to stderr, leaving stdout to the json
+    with contextlib.redirect_stdout(sys.stderr):
+        result = run_bot(args)
+    text = json.dumps(result, indent=1)
+    if args.output:
+        with open(args.output, 'w') as output:
+            output.write(text + '\n')
+    print(text)
+
+def run_bot(args):
+    import urllib.request
+    import fake_homeserver, metrics, service_matrix, test_matrix_bot
+    server = fake_homeserver.FakeHomeserver().start()
+    room_ids = [server.add_room(f'!room{idx}:localhost', f'room{idx}') for idx in range(args.rooms)]
+    lines = [line.split(': ', 1)[1] for line in SAMPLE_TEXT.split('\n') if line]
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as dir:
+        # the sync state is written to the working directory
+        os.chdir(dir)
+        model = tiny_rwkv(dir, args.layers, args.embd)
+        start = time.perf_counter()
+        bot = test_matrix_bot.Bot(homeserver=server.url, use_asyncio=args.asyncio, model=model, batch_size=args.batch, metrics_port=0, trace=args.trace)
+        bot.__enter__()
+        startup = time.perf_counter() - start
+        server.requests.clear()
+        service_matrix.request_seconds.values.clear()
+        stats = dict(model.stats)
+
+        ttft, latency = [], []
+        def converse(idx, room_id):
+            # one message at a time per room, each sent once the last is answered
+            for number in range(args.messages):
+                with server.condition:
+                    position = len(server.timeline)
+                sent = time.perf_counter()
+                msg_id = server.post(room_id, f'@user{(idx + number) % 3}:localhost', lines[(idx * args.messages + number) % len(lines)])
+                first, done = await_reply(server, room_id, msg_id, position, args.timeout)
+                ttft.append((first or done) - sent)
+                latency.append(done - sent)
+                time.sleep(args.think)
+        import threading
+        start = time.perf_counter()
+        threads = [threading.Thread(target=converse, args=(idx, room_id)) for idx, room_id in enumerate(room_ids)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        requests = dict(server.requests)
+        request_ms = {
+            call: total / count * 1000
+            for (call,), (buckets, count, total) in service_matrix.request_seconds.values.items()
+            if call != 'sync'
+        }
+        start = time.perf_counter()
+        with urllib.request.urlopen(f'http://127.0.0.1:{metrics.registry.server.server_port}/metrics') as response:
+            scraped = response.read().decode()
+        scrape = time.perf_counter() - start
+        stats = {key: model.stats[key] - stats[key] for key in ('prefill_tokens', 'prefill_time', 'decode_tokens', 'decode_time')}
+
+        # stop syncing, waking the pending sync with an event no module handles, before the state is saved
+        bot.stop()
+        server.post(room_ids[0], '@user0:localhost', None, type='m.room.topic', content={'topic': 'benchmark over'})
+        bot.wait()
+        bot.__exit__(None, None, None)
+        os.chdir(cwd)
+    server.stop()
+    return dict(
+        rooms = args.rooms, messages = args.messages, replies = len(latency), layers = args.layers, embd = args.embd,
+        asyncio = args.asyncio, batch = args.batch, startup_s = startup, elapsed_s = elapsed,
+        replies_per_s = len(latency) / elapsed,
+        ttft_ms = percentiles(ttft), latency_ms = percentiles(latency),
+        prefill_tokens = stats['prefill_tokens'], prefill_tokens_per_s = stats['prefill_tokens'] / max(stats['prefill_time'], 1e-9),
+        decode_tokens = stats['decode_tokens'], decode_tokens_per_s = stats['decode_tokens'] / max(stats['decode_time'], 1e-9),
+        requests = requests, requests_per_reply = sum(requests.values()) / max(len(latency), 1), request_mean_ms = request_ms,
+        metrics_scrape_ms = scrape * 1000, metrics_lines = scraped.count('\n'),
+    )
+
+CATCHUP_SCRIPT = """
+import contextlib, json, os, sys, time
+with contextlib.redirect_stdout(sys.stderr):
+    import module_rwkv, services
+    url, path, n_layer, n_embd, rooms, checkpoint_seconds, stream_after = sys.argv[1:8]
+    class Bot(services.Services):
+        # just the model, so nothing but the history is added to the rooms' states
+        def __init__(self):
+            super().__init__()
+            self.add_matrix('test_matrix_bot', 'test_matrix_bot', url)
+            model = module_rwkv.RWKVModel(path, os.path.abspath('state--tiny'), int(n_layer), int(n_embd), 1024)
+            self.rwkv = module_rwkv.RWKV(self, model = model, checkpoint_seconds = float(checkpoint_seconds), stream_after = int(stream_after))
+        def on_message(self, msg):
+            self.rwkv.on_message(msg)
+    start = time.perf_counter()
+    bot = Bot()
+    lane = bot.rwkv.default
+    while lane.stats['catch_ups'] < int(rooms) or lane.incoming.rooms_held():
+        time.sleep(0.01)
+    elapsed = time.perf_counter() - start
+    # the events confirmed to the server, read before the checkpoints that must already hold them
+    service = bot.services[0]
+    confirmed = dict(service.sync_state.resume)
+    written = {}
+    for name in confirmed:
+        path = lane.states.path((service, name)) + '.pt'
+        if os.path.exists(path):
+            written[name] = module_rwkv.torch.load(path)[1]['context_decoded'].get(name)
+    bot.rwkv.__exit__(None, None, None)
+print(json.dumps(dict(lane.stats, elapsed = elapsed, prefill_tokens = lane.rwkv.stats['prefill_tokens'], confirmed = confirmed, written = written)))
+sys.stdout.flush()
+os._exit(0)
+"""
+
+def bench_catchup(args):
+    # a bot coming back to long histories: once straight through, and once killed partway and restarted,
+    # which should pick up where its last checkpoint was and end with the same room states
+    import signal
+    import fake_homeserver
+    server = fake_homeserver.FakeHomeserver().start()
+    lines = [line.split(': ', 1)[1] for line in SAMPLE_TEXT.split('\n') if line]
+    history = {}
+    for idx in range(args.rooms):
+        room_id = server.add_room(f'!room{idx}:localhost', f'room{idx}')
+        history[f'room{idx}:localhost'] = [
+            server.post(room_id, f'@user{number % 5}:localhost', lines[(idx + number) % len(lines)])
+            for number in range(args.events - 1)
+        ]
+        # the bot's own message last, so nothing is replied to and the states hold only the history
+        history[f'room{idx}:localhost'].append(server.post(room_id, server.user_id, 'back'))
+    with tempfile.TemporaryDirectory() as dir:
+        path = tiny_model(os.path.join(dir, 'tiny'), args.layers, args.embd)
+        def room_file(run, name):
+            return os.path.join(dir, run, 'state--tiny--' + urllib.parse.quote(server.user_id, safe='') + '--' + urllib.parse.quote(name, safe='') + '.pt')
+        def start(run, stream_after = args.stream_after):
+            os.makedirs(os.path.join(dir, run), exist_ok=True)
+            return subprocess.Popen(
+                [sys.executable, '-c', CATCHUP_SCRIPT, server.url, path, str(args.layers), str(args.embd), str(args.rooms), str(args.checkpoint), str(stream_after)],
+                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True, cwd=os.path.join(dir, run),
+                env=dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(__file__))),
+            )
+        def finish(process):
+            stdout, stderr = process.communicate(timeout=args.timeout)
+            return json.loads(stdout.strip().split('\n')[-1])
+        def resumed(run):
+            # how many events of each room the states on disk hold
+            counts = {}
+            for name, ids in history.items():
+                if os.path.exists(room_file(run, name)):
+                    tensors, meta = torch.load(room_file(run, name))
+                    counts[name] = ids.index(meta['context_decoded'][name]) + 1
+                else:
+                    counts[name] = 0
+            return counts
+
+        # each room's history added as one text, without streaming or checkpoints
+        whole = finish(start('whole', 10**9))
+        straight = finish(start('straight'))
+        events, tokens, seconds = straight['streamed_events'], straight['streamed_tokens'], straight['stream_time']
+        print(f'{args.rooms} rooms of {args.events} events: {events} streamed in {seconds:.2f}s, {events / seconds:.0f} events/s, {tokens / seconds:.0f} tokens/s, '
+              f'{straight["stream_checkpoints"]} checkpoints; tokenizing took {straight["tokenize_time"]:.2f}s alongside')
+        print(f'from startup to caught up: {straight["elapsed"]:.2f}s streamed, {whole["elapsed"]:.2f}s with each history added whole')
+        # nothing is confirmed to the server before a checkpoint holding it is written
+        for run in (whole, straight):
+            for name, event_id in run['confirmed'].items():
+                written = run['written'].get(name)
+                # the bot's reactions follow the history, confirmed once its last event is
+                held = history[name].index(event_id) if event_id in history[name] else len(history[name]) - 1
+                assert written is not None and held <= history[name].index(written), (name, event_id, written)
+        print('every event confirmed to the server was in a checkpoint on disk')
+
+        process = start('killed')
+        first = list(history)[0]
+        while True:
+            if os.path.exists(room_file('killed', first)) and resumed('killed')[first] >= args.events * args.kill_at:
+                break
+            time.sleep(0.01)
+        process.send_signal(signal.SIGKILL)
+        process.wait()
+        counts = resumed('killed')
+        print('killed with ' + ', '.join([f'{name} at event {count}' for name, count in counts.items()]) + ' on disk')
+        restarted = finish(start('killed'))
+        # each room's events after its checkpoint, the last of them added as a message rather than streamed
+        expected = sum([args.events - count - 1 for count in counts.values() if args.events - count > args.stream_after + 1])
+        print(f'restarted: streamed {restarted["streamed_events"]} events, expected {expected}, in {restarted["stream_time"]:.2f}s; '
+              f'{restarted["prefill_tokens"]} tokens prefilled against {straight["prefill_tokens"]} straight through')
+        assert restarted['streamed_events'] == expected
+        for name in history:
+            a, b = torch.load(room_file('straight', name))[0]['state'], torch.load(room_file('killed', name))[0]['state']
+            a, b = a.float(), b.float()
+            finite = (a.abs() < 1e20) & (b.abs() < 1e20)
+            error = ((a - b).abs()[finite].max() / a.abs()[finite].max()).item()
+            print(f'{name}: state relative to straight through differs by {error:.2e}')
+            assert error < args.tolerance
+    server.stop()
+
+def bench_pool(args):
+    # two models of different sizes behind one bot, with a latency-sensitive room routed to the small one,
+    # then lazy loading and unloading of the two under a memory bound that only fits one of them
+    import contextlib
+    with contextlib.redirect_stdout(sys.stderr):
+        report = run_pool(args)
+    print('\n'.join(report))
+
+def run_pool(args):
+    import functools, threading
+    import fake_homeserver, module_rwkv, test_matrix_bot
+    server = fake_homeserver.FakeHomeserver().start()
+    room_ids = [server.add_room(f'!room{idx}:localhost', f'room{idx}') for idx in range(args.rooms)]
+    lines = [line.split(': ', 1)[1] for line in SAMPLE_TEXT.split('\n') if line]
+    report = []
+    def converse(rooms, messages):
+        # one message at a time per room, each sent once the last is answered, returning the latencies per room
+        latencies = {room_id: [] for room_id in rooms}
+        def run(idx, room_id):
+            for number in range(messages):
+                with server.condition:
+                    position = len(server.timeline)
+                sent = time.perf_counter()
+                msg_id = server.post(room_id, f'@user{(idx + number) % 3}:localhost', lines[(idx * messages + number) % len(lines)])
+                first, done = await_reply(server, room_id, msg_id, position, args.timeout)
+                latencies[room_id].append(done - sent)
+        threads = [threading.Thread(target=run, args=(idx, room_id)) for idx, room_id in enumerate(rooms)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return latencies
+    def stop(bot):
+        # stop syncing, waking the pending sync with an event no module handles, before the state is saved
+        bot.stop()
+        server.post(room_ids[0], '@user0:localhost', None, type='m.room.topic', content={'topic': 'benchmark over'})
+        bot.wait()
+        bot.__exit__(None, None, None)
+    def summary(values):
+        return ', '.join([f'{name} {value:.0f}ms' for name, value in percentiles(values).items()])
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as dir:
+        # the sync state is written to the working directory
+        os.chdir(dir)
+        shapes = {'big': (args.layers, args.embd), 'small': (args.small_layers, args.small_embd)}
+        loaders = {}
+        sizes = {}
+        for seed, (name, (n_layer, n_embd)) in enumerate(shapes.items()):
+            path = tiny_model(os.path.join(dir, name), n_layer, n_embd, seed = seed)
+            loaders[name] = functools.partial(module_rwkv.RWKVModel, path, os.path.join(dir, 'state--' + name), n_layer, n_embd, 1024)
+            # loaded once ahead, for its size and so the converted weights are cached
+            rwkv = loaders[name]()
+            sizes[name] = module_rwkv.weight_bytes(rwkv)
+            rwkv.checkpoints.close()
+            del rwkv
+        report.append(f'weights: big {sizes["big"] / 2**20:.1f}MiB, small {sizes["small"] / 2**20:.1f}MiB')
+
+        # room0 is latency-sensitive. with the big model alone it waits behind the other rooms; in the pool it has the small one
+        for models, routes in (({'big': loaders['big']}, {}), (loaders, {'room0:localhost': 'small'})):
+            bot = test_matrix_bot.Bot(homeserver=server.url, models=models, routes=routes, batch_size=args.batch, memory_bound=sum(sizes.values()) * 4)
+            bot.__enter__()
+            pool = bot.modules[-1]
+            latencies = converse(room_ids, args.messages)
+            stop(bot)
+            others = sum([latencies[room_id] for room_id in room_ids[1:]], [])
+            report.append(f'{"+".join(models)}: room0 {summary(latencies[room_ids[0]])}; other rooms {summary(others)}')
+            report.append('  ' + ', '.join([f'{lane.name} served {lane.stats["rooms"]} rooms' for lane in pool.lanes.values()]) + f', {pool.stats["moved"]} rooms moved by load')
+
+        # the bound fits either model but not both, so each is unloaded for the other, and both once idle
+        bot = test_matrix_bot.Bot(homeserver=server.url, models=loaders, routes={'room0:localhost': 'small', 'room1:localhost': 'big'}, batch_size=args.batch,
+                                  memory_bound=sizes['big'] + sizes['small'] / 2, idle=args.idle)
+        bot.__enter__()
+        pool = bot.modules[-1]
+        big, small = pool.lanes['big'], pool.lanes['small']
+        def loaded():
+            return ', '.join([f'{lane.name} {"loaded" if lane.rwkv is not None else "unloaded"}' for lane in (big, small)])
+        def settle(quiet = 0.5):
+            # waits for the lanes to have nothing to do for a while, as a model is only unloaded then:
+            # the history from the runs above is caught up on first, and the bot's own startup messages added
+            idle_since = time.monotonic()
+            while time.monotonic() - idle_since < quiet:
+                if any([lane.incoming.rooms_held() or lane.lock.locked() for lane in pool.lanes.values()]):
+                    idle_since = time.monotonic()
+                time.sleep(0.01)
+        settle()
+        report.append(f'bound {pool.memory_bound / 2**20:.1f}MiB, at startup: {loaded()}')
+        assert small.rwkv is None
+        for room_id in (room_ids[0], room_ids[1], room_ids[0]):
+            settle()
+            latency = converse([room_id], 1)[room_id][0]
+            report.append(f'message in {room_id.split(":")[0][1:]}: answered in {latency * 1000:.0f}ms, {loaded()}')
+            assert (big.rwkv is None) != (small.rwkv is None)
+        time.sleep(args.idle + 1.5)
+        report.append(f'after {args.idle}s idle: {loaded()}')
+        assert big.rwkv is None and small.rwkv is None
+        latency = converse([room_ids[0]], 1)[room_ids[0]][0]
+        report.append(f'message in room0: answered in {latency * 1000:.0f}ms, {loaded()}')
+        report.append(', '.join([f'{lane.name} loads {lane.stats["loads"]} unloads {lane.stats["unloads"]} last load {lane.load_seconds * 1000:.0f}ms' for lane in (big, small)]))
+        stop(bot)
+        os.chdir(cwd)
+    server.stop()
+    return report
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--layers', type=int, default=4)
+    parser.add_argument('--embd', type=int, default=256)
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+    prefill = subparsers.add_parser('prefill', help='chunked prefill equivalence and tokens/sec against the per-token loop')
+    prefill.add_argument('--tokens', type=int, default=512)
+    prefill.add_argument('--chunk', type=int, default=64)
+    prefill.add_argument('--repeat', type=int, default=3)
+    prefill.add_argument('--tolerance', type=float, default=1e-3)
+    prefill.set_defaults(func=bench_prefill)
+    events = subparsers.add_parser('events', help='matrix events converted per second')
+    events.add_argument('--count', type=int, default=100000)
+    events.add_argument('--recording', help='json list of raw matrix events to use instead of a synthetic stream')
+    events.set_defaults(func=bench_events)
+    decode = subparsers.add_parser('decode', help='batched greedy decoding equivalence and aggregate tokens/sec by batch size')
+    decode.add_argument('--batch', type=int, nargs='+', default=[1, 2, 4, 8])
+    decode.add_argument('--tokens', type=int, default=64)
+    decode.add_argument('--check', type=int, default=16)
+    decode.set_defaults(func=bench_decode)
+    sample = subparsers.add_parser('sample', help='per-token sampler overhead against plain argmax')
+    sample.add_argument('--batch', type=int, nargs='+', default=[1, 8])
+    sample.add_argument('--vocab', type=int, default=50277)
+    sample.add_argument('--repeat', type=int, default=200)
+    sample.set_defaults(func=bench_sample)
+    speculate = subparsers.add_parser('speculate', help='speculative decoding with a draft model against plain greedy decoding')
+    speculate.add_argument('--draft-layers', type=int, default=2)
+    speculate.add_argument('--refine', type=float, default=0.02, help='scale of the blocks past the draft\'s in the verifying model')
+    speculate.add_argument('--draft-tokens', type=int, default=4)
+    speculate.add_argument('--rooms', type=int, default=1)
+    speculate.add_argument('--chars', type=int, default=256)
+    speculate.add_argument('--replies', type=int, default=8, help='replies decoded with the choice to draft left to measurement')
+    speculate.set_defaults(func=bench_speculate)
+    startup = subparsers.add_parser('startup', help='model construction time and peak rss before and after the converted weights are cached')
+    startup.add_argument('--repeat', type=int, default=2)
+    startup.set_defaults(func=bench_startup)
+    quantize = subparsers.add_parser('quantize', help='int8 weights against float: logit agreement on a fixed prompt, weight size and decode speed')
+    quantize.add_argument('--tokens', type=int, default=256)
+    quantize.add_argument('--steps', type=int, default=64)
+    quantize.add_argument('--cosine', type=float, default=0.98, help='minimum cosine similarity of int8 and float logits')
+    quantize.add_argument('--bound', type=float, default=3 * 2**30, help='memory bound to choose the largest model for')
+    quantize.set_defaults(func=bench_quantize)
+    worker = subparsers.add_parser('worker', help='out-of-process inference: request overhead against in-process, state equivalence and restart after a kill')
+    worker.add_argument('--messages', type=int, default=8)
+    worker.add_argument('--chars', type=int, default=128)
+    worker.add_argument('--repeat', type=int, default=20)
+    worker.set_defaults(func=bench_worker)
+    resume = subparsers.add_parser('resume', help='matrix startup against a fake homeserver, with a full sync and resumed from a saved sync token')
+    resume.add_argument('--rooms', type=int, nargs='+', default=[10, 100, 1000])
+    resume.add_argument('--history', type=int, default=20)
+    resume.add_argument('--new', type=int, default=5)
+    resume.add_argument('--asyncio', action='store_true', help='use the asyncio matrix service')
+    resume.set_defaults(func=bench_resume)
+    bot = subparsers.add_parser('bot', help='end-to-end replies from a tiny model to scripted traffic on a fake homeserver, as json')
+    bot.add_argument('--rooms', type=int, default=4)
+    bot.add_argument('--messages', type=int, default=4, help='messages sent in each room, each after the last is answered')
+    bot.add_argument('--think', type=float, default=0.0, help='seconds between an answer and the next message in a room')
+    bot.add_argument('--batch', type=int, default=8)
+    bot.add_argument('--timeout', type=float, default=120)
+    bot.add_argument('--asyncio', action='store_true', help='use the asyncio matrix service')
+    bot.add_argument('--output', help='also write the json to this path')
+    bot.add_argument('--trace', action='store_true', help='time the stages of each message, logged at debug level')
+    bot.set_defaults(func=bench_bot)
+    catchup = subparsers.add_parser('catchup', help='streamed catch-up on long room histories: events/s and tokens/s, and resuming after a kill')
+    catchup.add_argument('--rooms', type=int, default=2)
+    catchup.add_argument('--events', type=int, default=1000, help='history of each room, up to the 1024 a sync returns')
+    catchup.add_argument('--checkpoint', type=float, default=1.0, help='seconds between checkpoints while streaming')
+    catchup.add_argument('--kill-at', type=float, default=0.3, help='fraction of the first room checkpointed before the kill')
+    catchup.add_argument('--stream-after', type=int, default=16)
+    catchup.add_argument('--tolerance', type=float, default=1e-2)
+    catchup.add_argument('--timeout', type=float, default=600)
+    catchup.set_defaults(func=bench_catchup)
+    pool = subparsers.add_parser('pool', help='a small and a big model behind one bot: per-room routing, and lazy loading and unloading under a memory bound')
+    pool.add_argument('--rooms', type=int, default=4)
+    pool.add_argument('--messages', type=int, default=4)
+    pool.add_argument('--small-layers', type=int, default=2)
+    pool.add_argument('--small-embd', type=int, default=64)
+    pool.add_argument('--batch', type=int, default=1, help='rooms replied to together, kept low so rooms wait on each other')
+    pool.add_argument('--idle', type=float, default=3.0, help='seconds before an idle model is unloaded')
+    pool.add_argument('--timeout', type=float, default=120)
+    pool.set_defaults(func=bench_pool)
+    commands = subparsers.add_parser('commands', help='command lookup cost for ordinary messages, and sandboxed !eval latency, timeouts and recovery')
+    commands.add_argument('--repeat', type=int, default=1000)
+    commands.add_argument('--evals', type=int, default=50)
+    commands.add_argument('--workers', type=int, default=2)
+    commands.add_argument('--timeout', type=float, default=2.0)
+    commands.set_defaults(func=bench_commands)
+    args = parser.parse_args()
+    args.func(args)
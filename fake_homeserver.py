@@ -0,0 +1,157 @@
+##### A small in-process stand-in for a matrix homeserver, for running the services offline.
+##### It implements just enough of the client-server api for service_matrix and service_matrix_async:
+#####  login, long-polling /sync over scripted room timelines, sending, redacting, typing and read markers.
+##### Every request is counted in .requests, so benchmarks can report how many calls the bot made.
+
+import collections, http.server, json, re, sys, threading, time, urllib.parse
+
+class FakeHomeserver(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+    def __init__(self, port = 0, user_id = '@test_matrix_bot:localhost'):
+        super().__init__(('127.0.0.1', port), FakeHomeserverHandler)
+        self.url = f'http://127.0.0.1:{self.server_port}'
+        self.user_id = user_id
+        self.condition = threading.Condition()
+        self.rooms = {}
+        self.timeline = [] # (room_id, event), a sync token is an index into this
+        self.requests = collections.Counter()
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+    def start(self):
+        self.thread.start()
+        return self
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+    def handle_error(self, request, client_address):
+        # clients going away mid-request, such as a bot that was killed, aren't errors of the server
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+    def add_room(self, room_id, name = None):
+        with self.condition:
+            state = [self._event(room_id, self.user_id, 'm.room.member', {'membership': 'join'}, state_key=self.user_id)]
+            if name is not None:
+                state.append(self._event(room_id, self.user_id, 'm.room.name', {'name': name}, state_key=''))
+            self.rooms[room_id] = state
+        return room_id
+    def post(self, room_id, sender, body, type = 'm.room.message', content = None, **extra):
+        # adds an event to a room's timeline, as if sent by another user
+        if content is None:
+            content = {'msgtype': 'm.text', 'body': body}
+        with self.condition:
+            event = self._event(room_id, sender, type, content, **extra)
+            self.timeline.append((room_id, event))
+            self.condition.notify_all()
+        return event['event_id']
+    def events(self, room_id = None, sender = None):
+        with self.condition:
+            return [
+                event for event_room_id, event in self.timeline
+                if room_id in (None, event_room_id) and sender in (None, event['sender'])
+            ]
+
+    def _event(self, room_id, sender, type, content, **extra):
+        event = dict(
+            event_id = f'${len(self.timeline)}.{time.monotonic_ns()}:localhost',
+            room_id = room_id,
+            sender = sender,
+            type = type,
+            content = content,
+            origin_server_ts = int(time.time() * 1000),
+            **extra,
+        )
+        return event
+    def sync(self, since, timeout_ms, limit = 20):
+        with self.condition:
+            if since is None:
+                # initial sync: room state and the end of each timeline
+                joined = {
+                    room_id: self._room(state, [event for event_room_id, event in self.timeline if event_room_id == room_id][-limit:])
+                    for room_id, state in self.rooms.items()
+                }
+            else:
+                since = int(since)
+                deadline = time.monotonic() + timeout_ms / 1000
+                while len(self.timeline) <= since and time.monotonic() < deadline:
+                    self.condition.wait(deadline - time.monotonic())
+                joined = {}
+                for room_id, event in self.timeline[since:]:
+                    joined.setdefault(room_id, self._room([], []))['timeline']['events'].append(event)
+            return {
+                'next_batch': str(len(self.timeline)),
+                'rooms': {'join': joined, 'invite': {}, 'leave': {}},
+                'presence': {'events': []},
+            }
+    @staticmethod
+    def _room(state, timeline):
+        return {
+            'state': {'events': list(state)},
+            'timeline': {'events': list(timeline), 'limited': False, 'prev_batch': '0'},
+            'ephemeral': {'events': []},
+            'account_data': {'events': []},
+        }
+
+class FakeHomeserverHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written separately, which would otherwise wait on delayed acks
+    disable_nagle_algorithm = True
+    routes = [
+        ('POST', r'/login', 'login'),
+        ('GET', r'/sync', 'sync'),
+        ('PUT', r'/rooms/([^/]+)/send/([^/]+)/([^/]+)', 'send'),
+        ('PUT', r'/rooms/([^/]+)/redact/([^/]+)/([^/]+)', 'redact'),
+        ('PUT', r'/rooms/([^/]+)/typing/([^/]+)', 'typing'),
+        ('POST', r'/rooms/([^/]+)/read_markers', 'read_markers'),
+        ('POST', r'/join/([^/]+)', 'join'),
+    ]
+    def do_GET(self):
+        self._route('GET')
+    def do_PUT(self):
+        self._route('PUT')
+    def do_POST(self):
+        self._route('POST')
+    def log_message(self, format, *args):
+        pass
+    def _route(self, method):
+        url = urllib.parse.urlparse(self.path)
+        path = re.sub(r'^/_matrix/client/(r0|v3)', '', url.path)
+        length = int(self.headers.get('Content-Length') or 0)
+        content = json.loads(self.rfile.read(length) or b'{}')
+        query = dict(urllib.parse.parse_qsl(url.query))
+        for route_method, pattern, name in self.routes:
+            match = re.fullmatch(pattern, path)
+            if route_method == method and match:
+                self.server.requests[name] += 1
+                params = [urllib.parse.unquote(param) for param in match.groups()]
+                return self._reply(200, getattr(self, name)(content, query, *params))
+        self._reply(404, {'errcode': 'M_UNRECOGNIZED', 'error': f'{method} {path}'})
+    def _reply(self, code, result):
+        body = json.dumps(result).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def login(self, content, query):
+        return {'user_id': self.server.user_id, 'access_token': 'fake_token', 'device_id': 'FAKE', 'home_server': 'localhost'}
+    def sync(self, content, query):
+        limit = 20
+        if 'filter' in query:
+            try:
+                limit = json.loads(query['filter'])['room']['timeline']['limit']
+            except (ValueError, KeyError):
+                pass
+        return self.server.sync(query.get('since'), int(query.get('timeout', 0)), limit)
+    def send(self, content, query, room_id, event_type, txn_id):
+        return {'event_id': self.server.post(room_id, self.server.user_id, None, event_type, content)}
+    def redact(self, content, query, room_id, event_id, txn_id):
+        return {'event_id': self.server.post(room_id, self.server.user_id, None, 'm.room.redaction', content, redacts=event_id)}
+    def typing(self, content, query, room_id, user_id):
+        return {}
+    def read_markers(self, content, query, room_id):
+        return {}
+    def join(self, content, query, room_id):
+        if room_id not in self.server.rooms:
+            self.server.add_room(room_id)
+        return {'room_id': room_id}
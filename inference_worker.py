@@ -0,0 +1,213 @@
+##### Runs an RWKVModel in a separate worker process, so forward passes don't hold the bot's GIL,
+#####  and a crash or hang in inference only costs a restart of the worker rather than the bot and its connections.
+##### Room states stay in the bot process, in shared memory: requests pass the worker handles to them, not copies,
+#####  and the worker only writes to them once an update is complete, so a restarted worker picks up where the last one was.
+
+import itertools, os, queue, time, traceback
+
+import module_rwkv
+
+class WorkerError(Exception):
+    pass
+
+class RemoteModel(module_rwkv.RWKVModel):
+    # stands in for an RWKVModel: add, prefixed and generate run in the worker,
+    # while the states, metadata and checkpoints are kept here and saved the way RWKVModel saves them.
+    def __init__(self, model_path, state_path, draft_path = None, timeout = 300, **kwparams):
+        module_rwkv._imports()
+        self.model_path = model_path
+        self.state_path = state_path
+        self.draft_path = draft_path
+        self.kwparams = kwparams
+        self.timeout = timeout
+        self.context = module_rwkv.torch.multiprocessing.get_context('spawn')
+        self.checkpoints = module_rwkv.Checkpointer(model = os.path.basename(model_path), state = os.path.basename(state_path))
+        self.prefixes = {}
+        # text can also be tokenized here, such as by a lane streaming history while the worker prefills
+        self.tokenizer = module_rwkv.RWKVTokenizer.default()
+        self.templates = module_rwkv.collections.OrderedDict()
+        self._sampler = module_rwkv.Sampler()
+        self.stats = dict(requests=0, restarts=0, request_time=0.0, template_hits=0, template_misses=0)
+        # each request carries a serial, so replies to a request that was abandoned or timed out are told apart and dropped
+        self.serials = itertools.count(1)
+        self.process = None
+        metadata, file_name, state, logits = self._start()
+        self.metadata = metadata
+        self.model = module_rwkv.types.SimpleNamespace(file_name=file_name, init_state=state, init_logits=logits)
+
+    @property
+    def sampler(self):
+        return self._sampler
+    @sampler.setter
+    def sampler(self, sampler):
+        self._sampler = sampler
+        self._call('sampler', sampler)
+
+    def advance(self, parts, state):
+        logits = self._call('advance', self.state_path, list(parts), self._shared(state))
+        return logits, state
+    def prefixed(self, text):
+        snapshot = self.prefixes.get(text)
+        if snapshot is None:
+            snapshot = self._call('prefixed', text)
+            self.prefixes[text] = snapshot
+        return snapshot
+    def generate(self, starts, sampler = None, max_chars = 256, keys = None):
+        starts = [(self._shared(state), self._shared(logits)) for state, logits in starts]
+        for attempt in range(2):
+            # on a restart generation begins again; its text is the same when greedy, and callers only use the latest
+            serial = None
+            try:
+                serial = self._send('generate', starts, sampler, max_chars, keys)
+                while True:
+                    try:
+                        kind, result = self._receive(serial)
+                    except RuntimeError:
+                        # the worker sends nothing more after an error
+                        serial = None
+                        raise
+                    if kind == 'done':
+                        serial = None
+                        return
+                    if kind != 'text':
+                        raise WorkerError(f'inference worker replied {kind} to generate')
+                    yield result
+            except WorkerError:
+                serial = None
+                if attempt:
+                    raise
+                self._restart()
+            finally:
+                # a caller that stops early leaves the worker generating; wait for the rest so the next request starts clean
+                if serial is not None:
+                    self._drain(serial)
+    def remote_stats(self):
+        return self._call('stats')
+    def ping(self):
+        return self._call('ping')
+
+    def __exit__(self, exc_t, exc_v, exc_tb):
+        super().__exit__(exc_t, exc_v, exc_tb)
+        self.stop()
+    def stop(self):
+        if self.process is not None and self.process.is_alive():
+            self.requests.put(None)
+            self.process.join(10)
+            if self.process.is_alive():
+                self.process.kill()
+        self.process = None
+
+    @staticmethod
+    def _shared(tensor):
+        if tensor is not None and not tensor.is_shared():
+            tensor.share_memory_()
+        return tensor
+    def _start(self):
+        self.requests = self.context.Queue()
+        self.responses = self.context.Queue()
+        self.process = self.context.Process(
+            target=_serve, args=(self.requests, self.responses, self.model_path, self.state_path, self.draft_path, self.kwparams), daemon=True,
+        )
+        self.process.start()
+        # loading the model can take much longer than a request, so only the worker exiting ends the wait
+        kind, result = self._receive(0, timeout = None)
+        return result
+    def _restart(self):
+        # a new worker loads the model again; states are still here, so nothing else is lost
+        self.stats['restarts'] += 1
+        if self.process is not None:
+            self.process.kill()
+            self.process.join()
+        self._start()
+        serial = next(self.serials)
+        self.requests.put((serial, 'sampler', self._sampler))
+        self._receive(serial)
+    def _call(self, kind, *params):
+        for attempt in range(2):
+            try:
+                start = time.monotonic()
+                serial = self._send(kind, *params)
+                kind_received, result = self._receive(serial)
+                if kind_received != kind:
+                    raise WorkerError(f'inference worker replied {kind_received} to {kind}')
+                self.stats['request_time'] += time.monotonic() - start
+                return result
+            except WorkerError:
+                if attempt:
+                    raise
+                self._restart()
+    def _send(self, kind, *params):
+        self.stats['requests'] += 1
+        serial = next(self.serials)
+        self.requests.put((serial, kind) + params)
+        return serial
+    def _drain(self, serial):
+        try:
+            while self._receive(serial)[0] != 'done':
+                pass
+        except WorkerError:
+            self._restart()
+        except RuntimeError:
+            pass
+    def _receive(self, serial, timeout = -1):
+        timeout = self.timeout if timeout == -1 else timeout
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            try:
+                serial_received, kind, result = self.responses.get(timeout=1)
+            except queue.Empty:
+                if not self.process.is_alive():
+                    raise WorkerError(f'inference worker exited with {self.process.exitcode}')
+                if deadline is not None and time.monotonic() > deadline:
+                    raise WorkerError(f'inference worker did not respond in {timeout}s')
+                continue
+            if serial_received != serial:
+                # left over from an earlier request
+                continue
+            if kind == 'error':
+                # the request failed but the worker is fine
+                raise RuntimeError(result)
+            return kind, result
+
+def _serve(requests, responses, model_path, state_path, draft_path, kwparams):
+    draft = None
+    if draft_path is not None:
+        draft = module_rwkv.RWKVModel(draft_path, 'state--' + os.path.basename(draft_path), quantize = kwparams.get('quantize', False))
+    rwkv = module_rwkv.RWKVModel(model_path, state_path, draft = draft, **kwparams)
+    def shared(tensor):
+        return None if tensor is None else tensor.detach().to('cpu', copy=True)
+    responses.put((0, 'ready', (rwkv.metadata, rwkv.model.file_name, shared(rwkv.model.init_state), shared(rwkv.model.init_logits))))
+    while True:
+        request = requests.get()
+        if request is None:
+            return
+        serial, kind, params = request[0], request[1], request[2:]
+        try:
+            if kind == 'advance':
+                state_path, parts, state = params
+                rwkv.state_path = state_path
+                # the shared state is only written once the prefill has finished
+                logits, work = rwkv.advance(parts, state.to(rwkv.state.device, copy=True))
+                state.copy_(work)
+                result = shared(logits)
+            elif kind == 'prefixed':
+                result = tuple([shared(tensor) for tensor in rwkv.prefixed(*params)])
+            elif kind == 'generate':
+                starts, sampler, max_chars, keys = params
+                starts = [(state.to(rwkv.state.device), None if logits is None else logits.to(rwkv.state.device)) for state, logits in starts]
+                for index, text, end in rwkv.generate(starts, sampler, max_chars, keys):
+                    if end is not None:
+                        end = tuple([shared(tensor) for tensor in end])
+                    responses.put((serial, 'text', (index, text, end)))
+                result = None
+                kind = 'done'
+            elif kind == 'sampler':
+                rwkv.sampler = params[0]
+                result = None
+            elif kind == 'stats':
+                result = dict(rwkv.stats)
+            elif kind == 'ping':
+                result = None
+            responses.put((serial, kind, result))
+        except Exception:
+            responses.put((serial, 'error', traceback.format_exc()))
@@ -0,0 +1,225 @@
+##### Counters, gauges and histograms for watching the bot while it runs, served over http in prometheus text format.
+##### Metrics are made once by name in the module's registry and can be updated from any thread, with labels given per update.
+##### The stats dicts that parts of the bot already keep are exported as they are, by registering them with collect().
+##### A tracer can also time each message's way through the bot, from its arrival to the end of its reply.
+
+import bisect, collections, http.server, logging, threading, time
+
+logger = logging.getLogger(__name__)
+
+class Metric:
+    kind = 'untyped'
+    def __init__(self, name, help, labels = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = {}
+    def _key(self, labels):
+        return tuple([str(labels.get(label, '')) for label in self.labels])
+    def samples(self):
+        # (name suffix, label values, value) for each value
+        with self.lock:
+            return [('', key, value) for key, value in self.values.items()]
+
+class Counter(Metric):
+    kind = 'counter'
+    def inc(self, amount = 1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+    kind = 'gauge'
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+    def inc(self, amount = 1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+class Histogram(Metric):
+    kind = 'histogram'
+    buckets = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+    def __init__(self, name, help, labels = (), buckets = None):
+        super().__init__(name, help, labels)
+        if buckets is not None:
+            self.buckets = tuple(buckets)
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is None:
+                entry = [[0] * len(self.buckets), 0, 0.0]
+                self.values[key] = entry
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                entry[0][index] += 1
+            entry[1] += 1
+            entry[2] += value
+    def time(self, **labels):
+        return _Timer(self, labels)
+    def samples(self):
+        samples = []
+        with self.lock:
+            for key, (counts, count, total) in self.values.items():
+                cumulative = 0
+                for bound, bucket in zip(self.buckets, counts):
+                    cumulative += bucket
+                    samples.append(('_bucket', key + (('le', repr(float(bound))),), cumulative))
+                samples.append(('_bucket', key + (('le', '+Inf'),), count))
+                samples.append(('_count', key, count))
+                samples.append(('_sum', key, total))
+        return samples
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+    def __exit__(self, *params):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+class Registry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+        self.collected = [] # (prefix, stats dict, labels)
+        self.server = None
+    def counter(self, name, help, labels = ()):
+        return self._get(Counter, name, help, labels)
+    def gauge(self, name, help, labels = ()):
+        return self._get(Gauge, name, help, labels)
+    def histogram(self, name, help, labels = (), buckets = None):
+        with self.lock:
+            if name not in self.metrics:
+                self.metrics[name] = Histogram(name, help, labels, buckets)
+            return self.metrics[name]
+    def collect(self, prefix, stats, **labels):
+        # exports a stats dict's numbers as prefix_key gauges when scraped. the dict is read, never copied, so it stays current.
+        with self.lock:
+            self.collected.append((prefix, stats, labels))
+    def discard(self, stats):
+        # stops exporting a collected stats dict, such as one of a model that was unloaded
+        with self.lock:
+            self.collected = [entry for entry in self.collected if entry[1] is not stats]
+    def _get(self, kind, name, help, labels):
+        with self.lock:
+            if name not in self.metrics:
+                self.metrics[name] = kind(name, help, labels)
+            return self.metrics[name]
+
+    def text(self):
+        # the prometheus text exposition format
+        lines = []
+        with self.lock:
+            metrics = list(self.metrics.values())
+            collected = list(self.collected)
+        for metric in metrics:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for suffix, key, value in metric.samples():
+                pairs = list(zip(metric.labels, key[:len(metric.labels)])) + list(key[len(metric.labels):])
+                lines.append(f'{metric.name}{suffix}{_labels(pairs)} {_number(value)}')
+        # samples of one name are kept together, as several dicts can be collected under the same prefix
+        samples = collections.defaultdict(list)
+        for prefix, stats, labels in collected:
+            for key, value in list(stats.items()):
+                if type(value) in (int, float, bool):
+                    samples[f'{prefix}_{key}'].append(f'{prefix}_{key}{_labels(labels.items())} {_number(value)}')
+        for name, named in samples.items():
+            lines.append(f'# TYPE {name} gauge')
+            lines.extend(named)
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port = 9100, host = '127.0.0.1'):
+        # serves text() at /metrics from a daemon thread, returning the server
+        registry = self
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = registry.text().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            def log_message(self, format, *args):
+                pass
+        self.server = http.server.ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        logger.info(f'metrics at http://{host}:{self.server.server_port}/metrics')
+        return self.server
+
+def _labels(pairs):
+    pairs = [(name, value) for name, value in pairs if value != '']
+    if not pairs:
+        return ''
+    return '{' + ','.join([f'{name}="{_escape(value)}"' for name, value in pairs]) + '}'
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _number(value):
+    if type(value) is bool:
+        return '1' if value else '0'
+    return repr(float(value)) if type(value) is float else str(value)
+
+class Tracer:
+    # times the stages of each message's handling: begin() when it arrives, stage() as it moves on, end() when done.
+    # each stage's duration goes to the message_stage_seconds histogram, and the whole span is logged at debug level
+    # with the context given to begin(), such as the room, which is kept out of the histograms' labels.
+    # nothing is recorded unless enabled. at most `limit` messages are followed at once, forgetting the oldest.
+    def __init__(self, registry, enabled = False, limit = 4096):
+        self.enabled = enabled
+        self.limit = limit
+        self.lock = threading.Lock()
+        self.spans = collections.OrderedDict() # key: (context, [(stage, start time)])
+        self.seconds = registry.histogram('message_stage_seconds', 'time messages spend in each stage of handling', ('stage',))
+    def begin(self, key, stage, context = None):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.spans[key] = (context, [(stage, time.perf_counter())])
+            while len(self.spans) > self.limit:
+                self.spans.popitem(last=False)
+    def stage(self, key, stage):
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        with self.lock:
+            context, span = self.spans.get(key, (None, None))
+            if span is None:
+                return
+            self.seconds.observe(now - span[-1][1], stage=span[-1][0])
+            span.append((stage, now))
+    def end(self, key):
+        # returns the seconds since begin, or None if key isn't followed
+        if not self.enabled:
+            return None
+        now = time.perf_counter()
+        with self.lock:
+            context, span = self.spans.pop(key, (None, None))
+        if span is None:
+            return None
+        self.seconds.observe(now - span[-1][1], stage=span[-1][0])
+        if logger.isEnabledFor(logging.DEBUG):
+            stages = [f'{stage} {((span[idx + 1][1] if idx + 1 < len(span) else now) - start) * 1000:.1f}ms' for idx, (stage, start) in enumerate(span)]
+            logger.debug(f'trace {key}{"" if context is None else f" in {context}"}: {", ".join(stages)}, total {(now - span[0][1]) * 1000:.1f}ms')
+        return now - span[0][1]
+
+registry = Registry()
+counter = registry.counter
+gauge = registry.gauge
+histogram = registry.histogram
+collect = registry.collect
+discard = registry.discard
+serve = registry.serve
+tracer = Tracer(registry)
@@ -1,6 +1,24 @@
+import builtins, random, time
+
+import metrics, sandbox
+
 class Commands:
-    def __init__(self, bot):
+    # commands are looked up by the first word of a message in a table filled by register(),
+    # so messages that aren't commands cost one dict lookup. a word ending in digits, like !d20, also matches its stem.
+    # expensive commands are run in a sandbox.Sandbox and answer when they finish, without holding up other events.
+    def __init__(self, bot, sandbox_workers = 2, timeout = 5.0):
         self.bot = bot
+        self.commands = {}
+        self.sandbox = sandbox.Sandbox(sandbox_workers, timeout)
+        self.seconds = metrics.histogram('command_seconds', 'time from a command being received to its answer', ('command',))
+        self.timeouts = metrics.counter('command_timeouts_total', 'commands stopped for taking too long', ('command',))
+        self.register('open%pdb', self.pdb)
+        self.register('raise%exception', self.exception)
+        self.register('shut%down', self.shut_down)
+        self.register('Hi', self.hi)
+        self.register('!echo', self.echo)
+        self.register('!d', self.dieroll)
+        self.register('!eval', self.eval)
         for service in self.bot.services:
             for room in service.rooms.values():
                 room.send("test_matrix_bot booting up")
@@ -8,52 +26,88 @@ class Commands:
         for service in self.bot.services:
             for room in service.rooms.values():
                 room.send("test_matrix_bot shutting down")
+        self.sandbox.stop()
+    def register(self, word, handler):
+        # handler(msg, text) is called for messages starting with word, with the text after it.
+        # it returns True if it answers later, and times itself.
+        self.commands[word] = handler
     def on_message(self, msg):
-        if msg.sender == msg.service.user_id:
+        if msg.sender == msg.service.user_id or msg.type != 'message' or not msg.data:
             return
-        if 'open%pdb' in msg.data:
-            msg.room.send("I'm opening a PDB session to look at my code. You can look at this too, at https://github.com/xloem/test_matrix_bot . TODO: put commit hash here")
-            import pdb; pdb.set_trace()
-            msg.room.send( "The PDB session has closed.") # remember to quit with `cont` rather than ^D to not spam the channel with BdbQuit backtrace
-        elif 'raise%exception' in msg.data:
-            msg.room.send( 'Are you sure? This is really scary ... Here we go; I\'ll raise an exception.')
-            raise Exception(f"{msg.sender} asked me to raise this but I'm worried about it.")
-        elif 'shut%down' in msg.data:
-            msg.room.send('Shutting down!')
-            self.bot.stop()
-        elif 'Hi' in msg.data:
-            msg.room.send( "Hi, " + msg.sender)
-        elif msg.data.startswith('!echo'):
-            msg.room.send( msg.data[len('!echo')+1:])
-        elif msg.data.startswith('!d'):
-            room, event = msg.raw
-            dieroll_callback(room, event)
-        elif msg.data.startswith('!eval '):
-            msg.room.send(str(eval(msg.data[len('!eval '):], globals(), locals())))
-        else:
+        word, space, text = msg.data.strip().partition(' ')
+        word = word.rstrip(',.!?') if word[:1] != '!' else word
+        handler = self.commands.get(word)
+        if handler is None and word[-1:].isdigit():
+            word, text = word.rstrip('0123456789'), word[len(word.rstrip('0123456789')):]
+            handler = self.commands.get(word)
+        if handler is None:
             return False
+        start = time.perf_counter()
+        if not handler(msg, text):
+            self.seconds.observe(time.perf_counter() - start, command=word)
         return True
 
-def dieroll_callback(room, event):
-    import random
-    # someone wants a random number
-    args = event['content']['body'].split()
+    def pdb(self, msg, text):
+        msg.room.send("I'm opening a PDB session to look at my code. You can look at this too, at https://github.com/xloem/test_matrix_bot . TODO: put commit hash here")
+        import pdb; pdb.set_trace()
+        msg.room.send( "The PDB session has closed.") # remember to quit with `cont` rather than ^D to not spam the channel with BdbQuit backtrace
+    def exception(self, msg, text):
+        msg.room.send( 'Are you sure? This is really scary ... Here we go; I\'ll raise an exception.')
+        raise Exception(f"{msg.sender} asked me to raise this but I'm worried about it.")
+    def shut_down(self, msg, text):
+        msg.room.send('Shutting down!')
+        self.bot.stop()
+    def hi(self, msg, text):
+        msg.room.send( "Hi, " + msg.sender)
+    def echo(self, msg, text):
+        msg.room.send(text)
+    def dieroll(self, msg, text):
+        msg.room.send(dieroll(text))
+    def eval(self, msg, text):
+        # runs in the sandbox, answering from one of its threads once done
+        start = time.perf_counter()
+        def answer(result, error):
+            if type(error) is sandbox.SandboxTimeout:
+                self.timeouts.inc(command='!eval')
+            self.seconds.observe(time.perf_counter() - start, command='!eval')
+            msg.room.send(result if error is None else str(error))
+        self.sandbox.submit(evaluate, (text,), answer)
+        return True
 
-    # we only care about the first arg, which has the die
-    die = args[0]
-    die_max = die[2:]
+# the builtins !eval can use. nothing that imports, opens files or reaches objects' internals.
+EVAL_BUILTINS = {
+    name: getattr(builtins, name)
+    for name in ('abs', 'all', 'any', 'bin', 'bool', 'chr', 'dict', 'divmod', 'enumerate', 'filter', 'float', 'format', 'frozenset',
+                 'hex', 'int', 'len', 'list', 'map', 'max', 'min', 'oct', 'ord', 'pow', 'range', 'repr', 'reversed', 'round',
+                 'set', 'sorted', 'str', 'sum', 'tuple', 'zip')
+}
+
+def evaluate(expression, limit = 4096):
+    # called in a sandbox worker, so the result is made a string there, however long that takes.
+    # names starting with _ are refused, so attributes like __class__ can't lead back to the real builtins.
+    code = compile(expression, '<eval>', 'eval')
+    pending = [code]
+    while pending:
+        code_part = pending.pop()
+        if any([name.startswith('_') for name in code_part.co_names]):
+            raise NameError('names starting with _ are not allowed')
+        pending.extend([const for const in code_part.co_consts if type(const) is type(code)])
+    result = str(eval(code, {'__builtins__': EVAL_BUILTINS}))
+    if len(result) > limit:
+        result = result[:limit] + f' ... ({len(result)} characters)'
+    return result
+
+def dieroll(die_max):
+    # someone wants a random number
 
     # ensure the die is a positive integer
     if not die_max.isdigit():
-        room.send_text('{} is not a positive number!'.format(die_max))
-        return
+        return '{} is not a positive number!'.format(die_max)
 
     # and ensure it's a reasonable size, to prevent bot abuse
     die_max = int(die_max)
     if die_max <= 1 or die_max >= 1000:
-        room.send_text('dice must be between 1 and 1000!')
-        return
+        return 'dice must be between 1 and 1000!'
 
     # finally, send the result back
-    result = random.randrange(1,die_max+1)
-    room.send_text(str(result))
+    return str(random.randrange(1,die_max+1))
@@ -1,27 +1,350 @@
-import os, psutil, queue, threading, types
+import collections, copy, functools, gc, logging, os, psutil, queue, threading, time, types, urllib.parse, warnings
 
-import tqdm, torch
-from prwkv.rwkvtokenizer import RWKVTokenizer
-from prwkv.rwkvrnnmodel import RWKVRNN4NeoForCausalLM
+import metrics, services
 
+logger = logging.getLogger(__name__)
 
-import services
+# torch and the model code take seconds to import, so they are imported by _imports() when a model is first constructed
+torch = RWKVTokenizer = RWKVRNN4NeoForCausalLM = RWKV_RNN = RWKV_RESCALE_LAYER = None
+MEMORY_BOUND = None
+# the float mode RWKVModel wants prwkv's model built in, and whether to quantize it, set while it calls from_pretrained
+_loading = threading.local()
+# the models RWKV can choose from, largest first, with their parameter counts
+MODELS = {
+    'RWKV-4-14B': 14*10**9,
+    'RWKV-4-3B': 3*10**9,
+    'RWKV-4-1B5': 1.5*10**9,
+    'RWKV-4-430M': 430*10**6,
+    'RWKV-4-169M': 169*10**6,
+}
+# the model that drafts for the others when decoding speculatively
+DRAFT = 'RWKV-4-169M'
 
-vm_snap, sw_snap = psutil.virtual_memory(), psutil.swap_memory()
-if torch.cuda.is_available():
-    # cuda: as much as cuda can hold if there is swap to transfer it
-    MEMORY_BOUND = min(vm_snap.free + sw_snap.free, torch.cuda.mem_get_info()[0])
-elif hasattr(vm_snap, 'buffers'):
-    # linux/bsd: reuse buffers for other tasks if swap can hold the buffers
-    MEMORY_BOUND = min(vm_snap.available - vm_snap.buffers + sw_snap.free, vm_snap.available)
-else:
-    # other: keep half of ram free, requiring as much swap as ram to use it
-    MEMORY_BOUND = (vm_snap.available + min(sw_snap.free, vm_snap.available)) / 2
-del vm_snap, sw_snap
+def _imports():
+    global torch, RWKVTokenizer, RWKVRNN4NeoForCausalLM, RWKV_RNN, RWKV_RESCALE_LAYER
+    if torch is not None:
+        return
+    from prwkv.rwkvtokenizer import RWKVTokenizer
+    from prwkv.rwkvrnnmodel import RWKVRNN4NeoForCausalLM
+    from prwkv.modelrun import RWKV_RNN, RWKV_RESCALE_LAYER
+    import prwkv.rwkvrnnmodel
+    prwkv.rwkvrnnmodel.RWKV_RNN = _mapped_rnn
+    import torch
+
+def probe_memory():
+    # how many bytes of weights and states can be held, probed on first use
+    global MEMORY_BOUND
+    if MEMORY_BOUND is not None:
+        return MEMORY_BOUND
+    _imports()
+    vm_snap, sw_snap = psutil.virtual_memory(), psutil.swap_memory()
+    if torch.cuda.is_available():
+        # cuda: as much as cuda can hold if there is swap to transfer it
+        MEMORY_BOUND = min(vm_snap.free + sw_snap.free, torch.cuda.mem_get_info()[0])
+    elif hasattr(vm_snap, 'buffers'):
+        # linux/bsd: reuse buffers for other tasks if swap can hold the buffers
+        MEMORY_BOUND = min(vm_snap.available - vm_snap.buffers + sw_snap.free, vm_snap.available)
+    else:
+        # other: keep half of ram free, requiring as much swap as ram to use it
+        MEMORY_BOUND = (vm_snap.available + min(sw_snap.free, vm_snap.available)) / 2
+    return MEMORY_BOUND
+
+def _mapped_rnn(args):
+    # stands in for RWKV_RNN(args) inside prwkv. the first load converts the checkpoint and saves the converted weights
+    # next to it; later loads memory-map those instead of reading, rescaling and casting the checkpoint again.
+    # prwkv builds fp32 first and rebuilds in the final mode, so the final mode is used from the start and only it is cached.
+    # quantized models are cached with their matrices already int8, so no load of them holds the float matrices.
+    args.FLOAT_MODE = getattr(_loading, 'float_mode', args.FLOAT_MODE)
+    quantize = getattr(_loading, 'quantize', False)
+    source = os.stat(args.MODEL_NAME + '.pth')
+    key = [source.st_size, source.st_mtime_ns, RWKV_RESCALE_LAYER]
+    path = converted_path(args.MODEL_NAME, args.FLOAT_MODE, quantize)
+    try:
+        converted = torch.load(path, mmap=True, map_location='cpu')
+        if converted['key'] != key:
+            raise ValueError(f'{path} is from a different checkpoint')
+    except (FileNotFoundError, ValueError, RuntimeError, KeyError):
+        torch.save({'key': key, 'weights': _converted(args, quantize)}, path + '.tmp')
+        os.replace(path + '.tmp', path)
+        gc.collect()
+        converted = torch.load(path, mmap=True, map_location='cpu')
+    rnn = RWKV_RNN.__new__(RWKV_RNN)
+    torch.nn.Module.__init__(rnn)
+    rnn.args, rnn.FLOAT_MODE, rnn.RUN_DEVICE = args, args.FLOAT_MODE, args.RUN_DEVICE
+    # nested the way RWKV_RNN.__init__ stores them, with numbered blocks in a dict
+    rnn.w = types.SimpleNamespace()
+    for name, w in converted['weights'].items():
+        if type(w) is tuple:
+            w = Int8Weight(*w)
+        elif args.RUN_DEVICE == 'cuda' and name != 'emb.weight':
+            w = w.cuda()
+        here = rnn.w
+        parts = name.split('.')
+        for idx, part in enumerate(parts[:-1]):
+            if part.isdigit():
+                here = here.setdefault(int(part), types.SimpleNamespace())
+            else:
+                if not hasattr(here, part):
+                    setattr(here, part, {} if parts[idx+1].isdigit() else types.SimpleNamespace())
+                here = getattr(here, part)
+        setattr(here, parts[-1], w)
+    rnn.eval()
+    return rnn
+
+def _converted(args, quantize):
+    # the weights RWKV_RNN.__init__ makes of a checkpoint, converted one at a time from the checkpoint memory-mapped,
+    # so only the converted weights are held. quantized matrices are their int8 values and scales.
+    try:
+        w = torch.load(args.MODEL_NAME + '.pth', mmap=True, map_location='cpu')
+    except RuntimeError:
+        # checkpoints saved in torch's legacy format can't be mapped
+        w = torch.load(args.MODEL_NAME + '.pth', map_location='cpu')
+    if 'pos_emb_x' in w:
+        w['pos_emb'] = (w['pos_emb_x'] + w['pos_emb_y']).reshape(args.ctx_len+1, -1)[:-1,:]
+    dtype = dict(fp32=torch.float, bf16=torch.bfloat16, fp16=torch.half)[args.FLOAT_MODE]
+    weights = {}
+    for name in list(w.keys()):
+        x = w.pop(name)
+        block_id = int(name.split('.')[1]) if 'blocks.' in name else 0
+        if 'att.output.weight' in name or 'ffn.value.weight' in name:
+            x = x / (2 ** int(block_id // RWKV_RESCALE_LAYER))
+        if '.time_' in name:
+            x = x.squeeze()
+        if '.time_decay' in name:
+            x = -torch.exp(x.float())
+        elif '.time_first' in name:
+            x = x.float()
+        elif quantize and _quantized(name):
+            x = Int8Weight.quantized(x)
+        else:
+            x = x.to(dtype, copy=True)
+        weights[name] = x
+    return weights
+
+def converted_path(model_name, float_mode, quantize = False):
+    # where _mapped_rnn caches a checkpoint's converted weights
+    return f'{model_name}.{float_mode}{".int8" if quantize else ""}.converted.pt'
+
+# the matrices RWKVModel.quantize replaces in each block, with the head
+QUANTIZED = ('att.key', 'att.value', 'att.receptance', 'att.output', 'ffn.key', 'ffn.value', 'ffn.receptance')
+
+def _quantized(name):
+    return name == 'head.weight' or (name.startswith('blocks.') and name.split('.', 2)[2][:-len('.weight')] in QUANTIZED)
+
+class Checkpointer(threading.Thread):
+    # writes state files from a background thread so saving doesn't stall inference.
+    # saves are snapshotted when requested, coalesced per path, and written at most every interval seconds
+    # unless `every` saves have accumulated. files are replaced atomically so a crash leaves the old one intact.
+    # a save's `written` callback is called once a snapshot at least as new as it has been written.
+    def __init__(self, interval = 10, every = 32, **labels):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.every = every
+        self.condition = threading.Condition()
+        self.write_lock = threading.Lock()
+        self.pending = {}
+        self.writing = {}
+        self.callbacks = {} # path: callbacks of its pending saves
+        self.count = 0
+        self.last_write = time.monotonic()
+        self.closed = False
+        self.stats = dict(requested=0, written=0)
+        self.seconds = metrics.histogram('checkpoint_write_seconds', 'time taken to write each state checkpoint')
+        metrics.collect('checkpoints', self.stats, **labels)
+        self.start()
+    def save(self, path, state, logits, model_name, metadata, written = None):
+        snapshot = (
+            {'state': state.detach().to('cpu', copy=True), 'logits': None if logits is None else logits.detach().to('cpu', copy=True)},
+            {'model_name': model_name, 'context_decoded': copy.copy(metadata)},
+        )
+        with self.condition:
+            # the newest save of a path is written after those requested before it, so the base state's metadata
+            # is never written ahead of the room states saved with it
+            self.pending.pop(path, None)
+            self.pending[path] = snapshot
+            if written is not None:
+                self.callbacks.setdefault(path, []).append(written)
+            self.count += 1
+            self.stats['requested'] += 1
+            self.condition.notify()
+    def load(self, path):
+        # returns the newest snapshot for path, whether or not it has been written yet
+        with self.condition:
+            snapshot = self.pending.get(path) or self.writing.get(path)
+        if snapshot is None:
+            snapshot = torch.load(path + '.pt')
+        return snapshot
+    def exists(self, path):
+        with self.condition:
+            if path in self.pending or path in self.writing:
+                return True
+        return os.path.exists(path + '.pt')
+    def flush(self):
+        with self.write_lock:
+            self._write()
+    def close(self):
+        # writes what is pending and ends the thread, for a model being unloaded
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.join()
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.pending and not self.closed:
+                    self.condition.wait()
+                while self.pending and not self.closed and self.count < self.every and time.monotonic() < self.last_write + self.interval:
+                    self.condition.wait(self.last_write + self.interval - time.monotonic())
+                closed = self.closed
+            with self.write_lock:
+                self._write()
+            if closed:
+                return
+    def _write(self):
+        with self.condition:
+            self.writing, self.pending = self.pending, {}
+            callbacks = {path: self.callbacks.pop(path) for path in self.writing if path in self.callbacks}
+            self.count = 0
+        for path, snapshot in self.writing.items():
+            logger.debug(f'saving {path}')
+            with self.seconds.time():
+                torch.save(snapshot, path + '.pt.tmp')
+                os.replace(path + '.pt.tmp', path + '.pt')
+            for written in callbacks.get(path, ()):
+                try:
+                    written()
+                except Exception:
+                    logger.exception(f'failed handling the write of {path}')
+        with self.condition:
+            self.stats['written'] += len(self.writing)
+            self.writing = {}
+            self.last_write = time.monotonic()
+
+class Template(str):
+    # text that recurs often, like a speaker header, whose token ids RWKVModel caches
+    pass
+
+class Int8Weight:
+    # a weight matrix stored as int8 with a scale per output channel, about a quarter of its fp32 size.
+    # it is multiplied through the cpu's dynamic int8 linear, which quantizes the activations on each call.
+    # made from a float matrix, or from the int8 values and scales of one as a converted cache stores them.
+    def __init__(self, weight, scale = None):
+        if scale is None:
+            weight, scale = Int8Weight.quantized(weight)
+        zero_points = torch.zeros(len(scale), dtype=torch.long)
+        qweight = torch._make_per_channel_quantized_tensor(weight, scale.double(), zero_points, 0)
+        self.packed = torch.ops.quantized.linear_prepack(qweight, None)
+        self.shape = weight.shape
+        self.nbytes = weight.nelement() + scale.nelement() * 8
+    @staticmethod
+    def quantized(weight):
+        # the int8 values of a float matrix, and the scale of each output channel
+        weight = weight.float()
+        scale = weight.abs().amax(dim=1).clamp(min=1e-12) / 127
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', UserWarning)
+            qweight = torch.quantize_per_channel(weight, scale.double(), torch.zeros(len(scale), dtype=torch.long), 0, torch.qint8)
+        return qweight.int_repr(), scale
+    def __call__(self, x):
+        out = torch.ops.quantized.linear_dynamic(x.reshape(-1, x.shape[-1]).float(), self.packed)
+        return out.reshape(*x.shape[:-1], -1).to(x.dtype)
+
+def _matmul(x, weight):
+    # x @ weight.T, for float or Int8Weight weights
+    if type(weight) is Int8Weight:
+        return weight(x)
+    return x @ weight.T
+
+class Sampler:
+    # picks next tokens from logits, on the device the logits are on.
+    # temperature 0 is greedy. otherwise candidates are limited to the top_k most likely and to the smallest set of
+    # those reaching probability top_p, found with partial topk rather than a sort of the whole vocabulary.
+    # ids among the last `window` chosen are penalized by repetition_penalty, and text ends at the first stop string.
+    def __init__(self, temperature = 0, top_k = 0, top_p = 1.0, repetition_penalty = 1.0, window = 64, stop = ('\n',), seed = None):
+        # samplers can be made before any model, such as to configure RWKV
+        _imports()
+        self.temperature = temperature
+        self.top_k = top_k
+        self.top_p = top_p
+        self.repetition_penalty = repetition_penalty
+        self.window = window
+        self.stop = tuple(stop)
+        self.seed = seed
+        self.generators = {}
+    def __call__(self, logits, recent = None):
+        # logits is shaped (batch, vocab) with recent a list of the ids each row chose, or (vocab,) with recent the ids
+        if logits.dim() == 1:
+            return self(logits[None], None if recent is None else [recent])[0]
+        if self.repetition_penalty != 1.0 and recent is not None:
+            logits = logits.clone()
+            for row, ids in enumerate(recent):
+                if ids:
+                    ids = torch.tensor(list(ids)[-self.window:], device=logits.device).unique()
+                    picked = logits[row, ids]
+                    logits[row, ids] = torch.where(picked > 0, picked / self.repetition_penalty, picked * self.repetition_penalty)
+        if self.temperature == 0:
+            return logits.argmax(dim=-1)
+        probs = torch.softmax(logits.float() / self.temperature, dim=-1)
+        k = min(self.top_k or probs.shape[-1], probs.shape[-1])
+        if self.top_p < 1.0:
+            # grow the candidates until every row's nucleus is among them
+            count = min(64, k)
+            while True:
+                top, ids = probs.topk(count, dim=-1)
+                if count == k or (top.sum(dim=-1) >= self.top_p).all():
+                    break
+                count = min(count * 4, k)
+            top[top.cumsum(dim=-1) - top >= self.top_p] = 0
+        elif k < probs.shape[-1]:
+            top, ids = probs.topk(k, dim=-1)
+        else:
+            return self._draw(probs)
+        return ids.gather(-1, self._draw(top)[:, None])[:, 0]
+    def _draw(self, weights):
+        # one categorical draw per row by inverting the cumulative weights, needing a single random number per row
+        cumulative = weights.cumsum(dim=-1)
+        uniform = torch.rand(weights.shape[0], 1, generator=self._generator(weights.device), device=weights.device)
+        ids = torch.searchsorted(cumulative, uniform * cumulative[:, -1:], right=True)
+        return ids[:, 0].clamp(max=weights.shape[-1] - 1)
+    def find_stop(self, text, start = 0):
+        # the position of the earliest stop string in text that ends after start, or None
+        positions = [
+            text.find(stop, max(0, start - len(stop) + 1))
+            for stop in self.stop
+        ]
+        positions = [position for position in positions if position >= 0]
+        return min(positions) if positions else None
+    def _generator(self, device):
+        if self.seed is None:
+            return None
+        generator = self.generators.get(device)
+        if generator is None:
+            generator = torch.Generator(device=device).manual_seed(self.seed)
+            self.generators[device] = generator
+        return generator
 
 class RWKVModel:
-    def __init__(self, model_path, state_path, n_layer = None, n_embd = None, ctx_len = None, default_ctx = None):
+    def __init__(self, model_path, state_path, n_layer = None, n_embd = None, ctx_len = None, default_ctx = None, chunk_size = 64, draft = None, draft_tokens = 4, quantize = False):
+        _imports()
         self.tokenizer = RWKVTokenizer.default()
+        self.chunk_size = chunk_size
+        # a smaller RWKVModel sharing the tokenizer, whose guesses are verified draft_tokens at a time when decoding greedily.
+        # its states follow each state_path through add(), and are only kept in memory; a draft without context just guesses worse.
+        # each verifying pass costs draft_tokens + 1 steps of the wkv recurrence and as many draft steps, so drafting only pays
+        # off for a single conversation with a draft that is much smaller and often agrees. a batch already shares each step.
+        # so replies to one conversation measure their decode time per token with and without the draft, and use whichever
+        # is faster, trying the other again every speculation_probe replies.
+        self.draft = draft
+        self.draft_tokens = draft_tokens
+        self.drafts = collections.OrderedDict()
+        self.speculation = None # True or False to always or never draft, rather than by measurement
+        self.speculation_probe = 16
+        self.templates = collections.OrderedDict()
+        self.prefixes = {}
+        self.stats = dict(prefill_tokens=0, prefill_tokens_avoided=0, prefill_time=0.0, decode_tokens=0, decode_time=0.0,
+                          template_hits=0, template_misses=0, speculative_steps=0, speculative_tokens=0, draft_proposed=0, draft_accepted=0,
+                          speculative_replies=0, plain_replies=0, speculative_token_seconds=0.0, plain_token_seconds=0.0)
+        self.sampler = Sampler()
         self.model = None
         if 'http' in model_path:
             fn = os.path.basename(model_patH)
@@ -31,8 +354,18 @@ class RWKVModel:
             model_path = fn
         self.model_path = model_path
         self.state_path = state_path
-        self.model = RWKVRNN4NeoForCausalLM.from_pretrained(model_path, n_layer, n_embd, ctx_len)
-        self.model.half('bf16')
+        # a model can be loaded more than once, such as as a draft and on its own, so its state file tells its metrics apart
+        labels = dict(model = os.path.basename(model_path), state = os.path.basename(state_path))
+        self.checkpoints = Checkpointer(**labels)
+        metrics.collect('rwkv_model', self.stats, **labels)
+        # bf16 needs cuda in prwkv
+        _loading.float_mode = 'bf16' if torch.cuda.is_available() else 'fp32'
+        # int8 matrices only run on cpu
+        _loading.quantize = quantize and not torch.cuda.is_available()
+        try:
+            self.model = RWKVRNN4NeoForCausalLM.from_pretrained(model_path, n_layer, n_embd, ctx_len)
+        finally:
+            del _loading.float_mode, _loading.quantize
         if torch.cuda.is_available():
             param_size = sum([w.nelement() * w.element_size() for w in self.model.model.parameters()])
             _pending = [(self.model.model.__dict__, 'w', self.model.model.w)]
@@ -47,14 +380,16 @@ class RWKVModel:
                 else:
                     _params.append((d, k, w))
                     param_size += w.nelement() * w.element_size()
-            if param_size < MEMORY_BOUND:
+            if param_size < probe_memory():
                 for d, k, w in _params:
                     d[k] = w.to('cuda')#.to(torch.bfloat16)
                 #self.model.model.to(torch.bfloat16)
                 self.model.model.to('cuda')
                 self.model.model.RUN_DEVICE = 'cuda'
+        if quantize and self.model.model.w.ln_out.weight.device.type == 'cpu':
+            self.quantize()
         try:
-            self.metadata = self.model.load_context(self.state_path)
+            self.metadata, model_name = self.model.load_context(self.state_path)
         except FileNotFoundError:
             self.model.clear_memory()
             if default_ctx:
@@ -66,67 +401,882 @@ class RWKVModel:
             self.model.init_state = self.model.init_state.to(self.model.model.w.emb.weight.dtype).to(self.model.model.w.emb.weight.device)
         else:
             self.model.init_state = torch.zeros(self.model.model.args.n_layer * 5, self.model.model.args.n_embd, dtype=self.model.model.w.emb.weight.dtype, device=self.model.model.w.emb.weight.device)
+    def quantize(self):
+        # replaces the matrices of every block, and the head, with Int8Weights, unless they were loaded as them.
+        # the float weights are dropped, so only _forward can run the model afterwards, not prwkv's own forward.
+        w = self.model.model.w
+        for linear in [w.head] + [getattr(getattr(block, part), name) for block in w.blocks.values() for part, name in [matrix.split('.') for matrix in QUANTIZED]]:
+            if type(linear.weight) is not Int8Weight:
+                linear.weight = Int8Weight(linear.weight)
     @property
     def state(self):
         return self.model.init_state
     def save(self, metadata = None):
-        print(f'saving {self.state_path} ...')
-        self.model.save_context(self.state_path, metadata or self.metadata)
         self.metadata = metadata or self.metadata
+        self.checkpoints.save(self.state_path, self.model.init_state, self.model.init_logits, self.model.file_name, self.metadata)
     def add(self, input_text, init_state = None, metadata = None):
-        input_ids = self.tokenizer.encode(input_text).ids
-        state = init_state or self.model.init_state
+        # input_text may be a list of strings, in which case Template parts have their tokens cached
+        if isinstance(input_text, str):
+            input_text = [input_text]
+        state = self.model.init_state if init_state is None else init_state
+        self.model.init_logits, self.model.init_state = self.advance(input_text, state)
+        self.save(metadata or ''.join(input_text))
+        return self
+    def advance(self, parts, state):
+        # prefills the text of parts into state without saving, returning (logits, state).
+        # parts can also be lists of token ids, already encoded. the draft model's state for state_path is kept in step.
+        input_ids = []
+        for part in parts:
+            input_ids.extend(part if type(part) is list else self.encode(part))
+        logits, state = self.prefill(input_ids, state)
+        if self.draft is not None:
+            draft_logits, self.drafts[self.state_path] = self.draft.prefill(input_ids, self._draft_state(self.state_path))
+        return logits, state
+    def encode(self, text):
+        if type(text) is not Template:
+            return self.tokenizer.encode(text).ids
+        input_ids = self.templates.get(text)
+        if input_ids is None:
+            self.stats['template_misses'] += 1
+            input_ids = self.tokenizer.encode(text).ids
+            if len(self.templates) >= 1024:
+                self.templates.popitem(last=False)
+        else:
+            self.stats['template_hits'] += 1
+            self.templates.move_to_end(text)
+        self.templates[text] = input_ids
+        return input_ids
+    def snapshot(self):
+        return (
+            self.model.init_state.clone(),
+            None if self.model.init_logits is None else self.model.init_logits.clone(),
+        )
+    def restore(self, snapshot):
+        state, logits = snapshot
+        self.model.init_state = state.clone()
+        self.model.init_logits = None if logits is None else logits.clone()
+    def prefixed(self, text):
+        # a snapshot of a fresh state after text, such as a system prompt, computed once and then reused
+        snapshot = self.prefixes.get(text)
+        input_ids = self.encode(Template(text))
+        if snapshot is None:
+            logits, state = self.prefill(input_ids, self._new_state())
+            snapshot = (state, logits)
+            self.prefixes[text] = snapshot
+        else:
+            self.stats['prefill_tokens_avoided'] += len(input_ids)
+        return snapshot
+    def prefill(self, input_ids, state, chunk_size = None):
+        # advances state over input_ids a chunk at a time, returning the logits after the last token.
+        # the matmuls for a whole chunk are done at once; only the cheap wkv recurrence is stepped per token.
+        chunk_size = chunk_size or self.chunk_size
+        start = time.perf_counter()
+        self.stats['prefill_tokens'] += len(input_ids)
+        if state is None:
+            state = self._new_state()
+        logits = self.model.init_logits
+        for offset in range(0, len(input_ids), chunk_size):
+            chunk = input_ids[offset:offset+chunk_size]
+            logits = self._forward_chunk(chunk, state, offset + chunk_size >= len(input_ids))
+        self.stats['prefill_time'] += time.perf_counter() - start
+        return logits, state
+    def _draft_state(self, key):
+        state = self.drafts.pop(key, None)
+        if state is None:
+            state = self.draft._new_state()
+        self.drafts[key] = state
+        if len(self.drafts) > 1024:
+            self.drafts.popitem(last=False)
+        return state
+    def _new_state(self):
+        args = self.model.model.args
+        state = torch.zeros(args.n_layer * 5, args.n_embd, device=self.model.model.w.ln_out.weight.device)
+        for i in range(args.n_layer):
+            state[5*i+4] -= 1e30
+        return state
+    def _prefill_serial(self, input_ids, state):
+        # the original one-forward-per-token path, kept for comparison with unquantized models
         for idx in range(len(input_ids) - 1):
            state = self.model.model.forward(input_ids[idx:idx+1], state, preprocess_only=True)
-        self.model.init_logits, self.model.init_state = self.model.model.forward(input_ids[-1:], state)
-        self.model.save_context(self.state_path, metadata or input_text)
-        self.metadata = metadata or input_text
-        return self
+        return self.model.model.forward(input_ids[-1:], state)
+    def _forward_chunk(self, input_ids, state, logits = True):
+        # time-parallel equivalent of RWKV_RNN.forward, updating state in place the same way
+        logits = self._forward([input_ids], state[None], logits)
+        return None if logits is None else logits[0]
+    def _forward(self, input_ids, states, logits = True, trace = False):
+        # advances a batch of states, shaped (batch, n_layer * 5, n_embd), over the same number of tokens each.
+        # input_ids is shaped (batch, tokens); states are updated in place and the logits after the last tokens returned.
+        # with trace, the logits and states after every token are returned instead, shaped (batch, tokens, ...).
+        rnn = self.model.model
+        w = rnn.w
+        with torch.no_grad():
+            input_ids = torch.as_tensor(input_ids, device=w.emb.weight.device)
+            x = w.emb.weight[input_ids].to(w.ln_out.weight.device)
+            if hasattr(w, 'pos_emb'):
+                x = x + w.pos_emb[0]
+            dtype = x.dtype
+            if trace:
+                traced = states[:, None].repeat(1, input_ids.shape[1], 1, 1)
+            for i in range(rnn.args.n_layer):
+                block = w.blocks[i]
+                if i == 0:
+                    x = rnn.LN(x, block.ln0)
+
+                ww = block.att
+                xx = rnn.LN(x, block.ln1)
+                last = torch.cat((states[:, 5*i+1].to(dtype)[:, None], xx[:, :-1]), dim=1)
+                xk = xx * ww.time_mix_k + last * (1 - ww.time_mix_k)
+                xv = xx * ww.time_mix_v + last * (1 - ww.time_mix_v)
+                xr = xx * ww.time_mix_r + last * (1 - ww.time_mix_r)
+                states[:, 5*i+1] = xx[:, -1].float()
+                if trace:
+                    traced[:, :, 5*i+1] = xx.float()
+                r = torch.sigmoid(_matmul(xr, ww.receptance.weight))
+                k = _matmul(xk, ww.key.weight).float()
+                v = _matmul(xv, ww.value.weight).float()
+                aa, bb, pp = states[:, 5*i+2].float(), states[:, 5*i+3].float(), states[:, 5*i+4].float()
+                wkv = torch.empty_like(k)
+                for t in range(input_ids.shape[1]):
+                    kk, vv = k[:, t], v[:, t]
+                    ww_ = ww.time_first + kk
+                    p = torch.maximum(pp, ww_)
+                    e1, e2 = torch.exp(pp - p), torch.exp(ww_ - p)
+                    wkv[:, t] = (e1 * aa + e2 * vv) / (e1 * bb + e2)
+                    ww_ = pp + ww.time_decay
+                    p = torch.maximum(ww_, kk)
+                    e1, e2 = torch.exp(ww_ - p), torch.exp(kk - p)
+                    aa, bb, pp = e1 * aa + e2 * vv, e1 * bb + e2, p
+                    if trace:
+                        traced[:, t, 5*i+2], traced[:, t, 5*i+3], traced[:, t, 5*i+4] = aa, bb, pp
+                states[:, 5*i+2], states[:, 5*i+3], states[:, 5*i+4] = aa, bb, pp
+                x = x + _matmul(r * wkv.to(dtype), ww.output.weight)
+
+                ww = block.ffn
+                xx = rnn.LN(x, block.ln2)
+                last = torch.cat((states[:, 5*i+0].to(dtype)[:, None], xx[:, :-1]), dim=1)
+                xk = xx * ww.time_mix_k + last * (1 - ww.time_mix_k)
+                xr = xx * ww.time_mix_r + last * (1 - ww.time_mix_r)
+                states[:, 5*i+0] = xx[:, -1].float()
+                if trace:
+                    traced[:, :, 5*i+0] = xx.float()
+                r = torch.sigmoid(_matmul(xr, ww.receptance.weight))
+                k = torch.square(torch.relu(_matmul(xk, ww.key.weight)))
+                x = x + r * _matmul(k, ww.value.weight)
+
+                if (i+1) % RWKV_RESCALE_LAYER == 0:
+                    x = x / 2
+            if trace:
+                return self._head(rnn.LN(x, w.ln_out)), traced
+            if not logits:
+                return None
+            return self._head(rnn.LN(x[:, -1], w.ln_out))
+    def _head(self, x):
+        head = self.model.model.w.head.weight
+        if type(head) is Int8Weight:
+            return head(x).float()
+        # the vocabulary-sized matmul is faster with the weight on the left
+        return (head @ x.reshape(-1, x.shape[-1]).T).T.reshape(*x.shape[:-1], -1).float()
+    def generate(self, starts, sampler = None, max_chars = 256, keys = None):
+        # continues several conversations together, with one forward for the whole batch per step.
+        # starts holds a (state, logits) pair per conversation, which are left unchanged.
+        # yields (index, text, end) each time a conversation's text grows. a conversation is retired once its
+        # text reaches one of the sampler's stop strings or max_chars, and its end is then its final (state, logits) rather than None.
+        # keys are the state paths of the conversations; when given for one conversation and decoding is plainly greedy,
+        # steps may use the draft model.
+        sampler = sampler or self.sampler
+        greedy = self.draft is not None and keys is not None and sampler.temperature == 0 and sampler.repetition_penalty == 1.0
+        measure = greedy and len(starts) == 1
+        speculate = greedy and self.speculation if self.speculation is not None else measure and self._speculation_pays()
+        measured_time, measured_tokens = 0.0, 0
+        states = torch.stack([state.float() for state, logits in starts])
+        logits = torch.stack([logits.float() for state, logits in starts])
+        if speculate:
+            draft_states = torch.stack([self._draft_state(key).float() for key in keys])
+        active = list(range(len(starts)))
+        decoders = [IncrementalDecoder(self.tokenizer) for start in starts]
+        recent = [collections.deque(maxlen=sampler.window) for start in starts]
+        texts = ['' for start in starts]
+        while active:
+            start = time.perf_counter()
+            if speculate:
+                # every row's tokens up to its first rejected guess, with the logits and states after each
+                token_ids, counts, all_logits, traced, draft_traced = self._speculate(logits, states, draft_states)
+            else:
+                token_ids = sampler(logits, [recent[index] for index in active])[:, None]
+                counts = [1] * len(active)
+                logits = self._forward(token_ids, states)
+                all_logits, traced = logits[:, None], states[:, None]
+            self.stats['decode_tokens'] += sum(counts)
+            self.stats['decode_time'] += time.perf_counter() - start
+            measured_time += time.perf_counter() - start
+            measured_tokens += sum(counts)
+            keep, positions = [], []
+            for row, index in enumerate(active):
+                for position in range(counts[row]):
+                    recent[index].append(int(token_ids[row, position]))
+                    token = decoders[index](token_ids[row, position])
+                    if not texts[index]:
+                        token = token.lstrip()
+                    length = len(texts[index])
+                    texts[index] += token
+                    stop = sampler.find_stop(texts[index], length)
+                    done = stop is not None
+                    if done:
+                        texts[index] = texts[index][:stop]
+                    if not done and len(texts[index]) >= max_chars:
+                        texts[index] += ' ...'
+                        done = True
+                    if done:
+                        dtype = starts[index][0].dtype
+                        if speculate:
+                            self.drafts[keys[index]] = draft_traced[row, position].clone()
+                        yield index, texts[index], (traced[row, position].to(dtype, copy=True), all_logits[row, position].clone())
+                        break
+                    if token:
+                        yield index, texts[index], None
+                else:
+                    keep.append(row)
+                    positions.append(counts[row] - 1)
+            active = [active[row] for row in keep]
+            if speculate:
+                logits, states, draft_states = all_logits[keep, positions], traced[keep, positions], draft_traced[keep, positions]
+            elif len(keep) < len(traced):
+                states, logits = states[keep], logits[keep]
+        if measure and measured_tokens:
+            mode = 'speculative' if speculate else 'plain'
+            token_seconds = measured_time / measured_tokens
+            previous = self.stats[mode + '_token_seconds']
+            self.stats[mode + '_token_seconds'] = token_seconds if not previous else previous * 0.7 + token_seconds * 0.3
+            self.stats[mode + '_replies'] += 1
+    def _speculation_pays(self):
+        # whether to draft the next reply: each way is measured first, then the faster is used, and the slower tried again now and then
+        speculative, plain = self.stats['speculative_token_seconds'], self.stats['plain_token_seconds']
+        if not speculative or not plain:
+            return not speculative
+        faster = speculative < plain
+        if (self.stats['speculative_replies'] + self.stats['plain_replies']) % self.speculation_probe == 0:
+            return not faster
+        return faster
+    def _speculate(self, logits, states, draft_states):
+        # the draft guesses draft_tokens ahead of the model's own greedy next token, and the model checks them all in one pass.
+        # the model's tokens are kept up to the first guess it disagrees with, so output matches plain greedy decoding.
+        batch = logits.shape[0]
+        token_ids = [logits.argmax(dim=-1)]
+        draft_traced = []
+        for position in range(self.draft_tokens + 1):
+            draft_logits = self.draft._forward(token_ids[-1][:, None], draft_states)
+            draft_traced.append(draft_states.clone())
+            if position < self.draft_tokens:
+                token_ids.append(draft_logits.argmax(dim=-1))
+        token_ids = torch.stack(token_ids, dim=1)
+        all_logits, traced = self._forward(token_ids, states, trace=True)
+        agree = (all_logits[:, :-1].argmax(dim=-1) == token_ids[:, 1:]).int()
+        counts = (agree.cumprod(dim=1).sum(dim=1) + 1).tolist()
+        self.stats['speculative_steps'] += batch
+        self.stats['speculative_tokens'] += sum(counts)
+        self.stats['draft_proposed'] += batch * self.draft_tokens
+        self.stats['draft_accepted'] += sum(counts) - batch
+        return token_ids, counts, all_logits, traced, torch.stack(draft_traced, dim=1)
     def __enter__(self):
         return self
     def __exit__(self, exc_t, exc_v, exc_tb):
         self.save()
-    def _ids_by_prob(self):
-        logits, ids = self.model.init_logits.sort(descending=True)
+        self.checkpoints.flush()
+    def _ids_by_prob(self, k = 64):
+        logits, ids = self.model.init_logits.topk(k)
         return ids
     def __iter__(self):
+        # yields the text of each token chosen by self.sampler, or '' while a token only holds part of a character
+        decoder = IncrementalDecoder(self.tokenizer)
+        recent = collections.deque(maxlen=self.sampler.window)
         while True:
-            token_id = self.model.init_logits.argmax()
-            self.model.init_logits, self.model.init_state = self.model.model.forward([token_id], self.model.init_state)
-            yield self.tokenizer.decode((token_id,))
+            token_id = self.sampler(self.model.init_logits, recent)
+            recent.append(int(token_id))
+            self.model.init_logits = self._forward([[token_id]], self.model.init_state[None])[0]
+            yield decoder(token_id)
+
+class IncrementalDecoder:
+    # byte-level tokens can split a multi-byte character, which decodes as U+FFFD on its own.
+    # such tokens are held back and decoded together with the following ones.
+    def __init__(self, tokenizer, max_pending = 4):
+        self.tokenizer = tokenizer
+        self.max_pending = max_pending
+        self.pending = []
+    def __call__(self, token_id):
+        self.pending.append(int(token_id))
+        text = self.tokenizer.decode(self.pending)
+        if text.endswith('\ufffd') and len(self.pending) < self.max_pending:
+            return ''
+        self.pending = []
+        return text
+
+class RoomStates:
+    # a recurrent state per (service, room name), so conversations don't bleed into each other.
+    # the most recently active states stay on the model device, colder ones move to (pinned) cpu memory,
+    # and the coldest are spilled to files next to the model's state file, loaded back when a room is activated.
+    # the active room's state is the one in rwkv.model.init_state, and rwkv.state_path follows it.
+    def __init__(self, rwkv, resident = 8, memory_bound = None, system_prompt = None, **labels):
+        # new rooms start from the model's loaded state, or from the state after system_prompt if one is given
+        if memory_bound is None:
+            memory_bound = probe_memory()
+        self.rwkv = rwkv
+        self.base_path = rwkv.state_path
+        self.base = rwkv.snapshot()
+        self.system_prompt = system_prompt
+        self.device = self.base[0].device
+        entry_size = sum([t.nelement() * t.element_size() for t in self.base if t is not None])
+        entry_count = max(1, int(memory_bound // entry_size))
+        self.resident_limit = max(1, min(resident, entry_count // 2))
+        self.cpu_limit = max(0, entry_count - self.resident_limit)
+        self.resident = collections.OrderedDict()
+        self.cpu = collections.OrderedDict()
+        self.dirty = set()
+        self.active = None
+        self.stats = dict(hits=0, misses=0, evictions=0, spills=0, loads=0)
+        metrics.collect('rwkv_room_states', self.stats, **labels)
+    def path(self, key):
+        service, room_name = key
+        return f'{self.base_path}--{urllib.parse.quote(service.user_id, safe="")}--{urllib.parse.quote(room_name, safe="")}'
+    def activate(self, room):
+        key = (room.service, room.name)
+        if key == self.active:
+            return
+        model = self.rwkv.model
+        if self.active is not None:
+            self.resident[self.active] = (model.init_state, model.init_logits)
+            self.dirty.add(self.active)
+        model.init_state, model.init_logits = self._take(key)
+        self.rwkv.state_path = self.path(key)
+        self.active = key
+        self._evict()
+    def save(self, metadata, written = None):
+        # writes the active room, any modified inactive rooms, and the shared metadata with the base state.
+        # the base state is saved last, so written is called once all of them are written.
+        if self.active is not None:
+            self.rwkv.save(metadata)
+        for key in list(self.dirty):
+            entry = self.resident.get(key) or self.cpu.get(key)
+            if entry is not None:
+                self._write(key, entry, metadata)
+        self.dirty.clear()
+        self._write(None, self.base, metadata, written)
+    def _take(self, key):
+        if key in self.resident:
+            self.stats['hits'] += 1
+            return self.resident.pop(key)
+        self.stats['misses'] += 1
+        if key in self.cpu:
+            return self._to(self.device, self.cpu.pop(key))
+        # the room's entry in the metadata is made to match the state it gets: what was saved with it, or nothing for a new one.
+        # the shared metadata can be ahead of a room's file when the bot stopped before the file was written.
+        service, room_name = key
+        path = self.path(key)
+        if self.rwkv.checkpoints.exists(path):
+            self.stats['loads'] += 1
+            tensors, meta = self.rwkv.checkpoints.load(path)
+            saved = meta.get('context_decoded')
+            self._resume(room_name, saved.get(room_name) if type(saved) is dict else None)
+            return self._to(self.device, (tensors['state'], tensors['logits']))
+        self._resume(room_name, None)
+        if self.system_prompt is not None:
+            return tuple([None if t is None else t.clone() for t in self.rwkv.prefixed(self.system_prompt)])
+        return tuple([None if t is None else t.clone() for t in self.base])
+    def _resume(self, room_name, event_id):
+        if event_id is None:
+            self.rwkv.metadata.pop(room_name, None)
+        else:
+            self.rwkv.metadata[room_name] = event_id
+    def _evict(self):
+        # the active state counts against the resident limit
+        while len(self.resident) + 1 > self.resident_limit:
+            key, entry = self.resident.popitem(last=False)
+            self.cpu[key] = self._to('cpu', entry)
+            self.stats['evictions'] += 1
+        while len(self.cpu) > self.cpu_limit:
+            key, entry = self.cpu.popitem(last=False)
+            if key in self.dirty:
+                self._write(key, entry, self.rwkv.metadata)
+                self.dirty.discard(key)
+            self.stats['spills'] += 1
+    def _write(self, key, entry, metadata, written = None):
+        state, logits = entry
+        path = self.base_path if key is None else self.path(key)
+        self.rwkv.checkpoints.save(path, state, logits, self.rwkv.model.file_name, metadata, written)
+    @staticmethod
+    def _to(device, entry):
+        pin = device == 'cpu' and torch.cuda.is_available()
+        return tuple([
+            None if t is None else t.to(device).pin_memory() if pin else t.to(device)
+            for t in entry
+        ])
 
-class RWKV(threading.Thread):
-    def __init__(self, bot):
+class Admission:
+    # the messages waiting for the model, grouped by room.
+    # all of a room's queued messages are taken at once so they can be prefilled as one text.
+    # rooms take turns, with rooms that will be replied to served first, and the messages queued
+    # per room and per sender are limited, dropping the oldest.
+    def __init__(self, room_limit = 256, sender_limit = 64, **labels):
+        self.room_limit = room_limit
+        self.sender_limit = sender_limit
+        self.condition = threading.Condition()
+        self.rooms = {}
+        self.order = collections.deque()
+        self.busy = set() # rooms taken by get() and not yet done()
+        self.arrivals = {} # message id: time it was put
+        self.stats = dict(admitted=0, dropped=0, merged=0, queued=0)
+        metrics.collect('rwkv_admission', self.stats, **labels)
+    def put(self, msg):
+        key = (msg.service, msg.room.name)
+        with self.condition:
+            msgs = self.rooms.get(key)
+            if msgs is None:
+                msgs = collections.deque()
+                self.rooms[key] = msgs
+                self.order.append(key)
+            msgs.append(msg)
+            self.arrivals[msg.id] = time.perf_counter()
+            self.stats['admitted'] += 1
+            self.stats['queued'] += 1
+            if len([queued for queued in msgs if queued.sender == msg.sender]) > self.sender_limit:
+                for queued in msgs:
+                    if queued.sender == msg.sender:
+                        msgs.remove(queued)
+                        self._drop(queued)
+                        break
+            if len(msgs) > self.room_limit:
+                self._drop(msgs.popleft())
+            self.condition.notify()
+    def _drop(self, msg):
+        self.arrivals.pop(msg.id, None)
+        self.stats['dropped'] += 1
+        self.stats['queued'] -= 1
+    def get(self, exclude = (), timeout = None):
+        # returns the queued messages of the next room, oldest first, or None if there are none within timeout.
+        # rooms whose keys are in exclude are only taken to be replied to if no other room is.
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.order, timeout):
+                return None
+            for key in self.order:
+                if key not in exclude and self._replies(self.rooms[key][-1]):
+                    break
+            else:
+                key = self.order[0]
+            self.order.remove(key)
+            self.busy.add(key)
+            msgs = list(self.rooms.pop(key))
+            self.stats['merged'] += len(msgs) - 1
+            self.stats['queued'] -= len(msgs)
+            return msgs
+    def arrival(self, msgs):
+        # forgets when msgs were put, returning the time the last of them was
+        with self.condition:
+            times = [self.arrivals.pop(msg.id, None) for msg in msgs]
+        return times[-1]
+    def done(self, keys):
+        # the rooms taken by get() have been handled
+        with self.condition:
+            self.busy.difference_update(keys)
+    def holds(self, key):
+        # whether the room has messages queued or being handled
+        with self.condition:
+            return key in self.rooms or key in self.busy
+    def rooms_held(self):
+        with self.condition:
+            return len(self.rooms) + len(self.busy)
+    def qsize(self):
+        with self.condition:
+            return sum([len(msgs) for msgs in self.rooms.values()])
+    def empty(self):
+        return not self.order
+    def replying(self, exclude = ()):
+        # whether a queued room not in exclude will be replied to, so get(exclude) would return it without waiting
+        with self.condition:
+            return any([key not in exclude and self._replies(self.rooms[key][-1]) for key in self.order])
+    @staticmethod
+    def _replies(msg):
+        return msg.room.voice and msg.sender != msg.service.user_id
+
+class Lane(threading.Thread):
+    # one model of an RWKV pool, with its own room states and queue, serving the rooms routed to it from its own thread.
+    # the model is made by load() when the lane first has work, and unloaded again when idle or when another model needs
+    # the memory. a lane given a model made by the caller has no load() and keeps it.
+    def __init__(self, pool, name, load = None, rwkv = None, weight_bytes = None):
         super().__init__(daemon=True)
-        self.bot = bot
-        models = {
-            'RWKV-4-14B': 14*10**9,
-            'RWKV-4-3B': 3*10**9,
-            'RWKV-4-1B5': 1.5*10**9,
-            'RWKV-4-430M': 430*10**6,
-            'RWKV-4-169M': 169*10**6,
-        }
-        for MODEL, param_count in models.items():
-            if MEMORY_BOUND > param_count * 2:
+        self.pool = pool
+        self.name = name
+        self.load = load
+        self.given = rwkv
+        self.rwkv = None
+        self.states = None
+        self.weight_bytes = weight_bytes # estimated until loaded, then measured if the weights are in this process
+        self.incoming = Admission(model = name)
+        self.lock = threading.Lock() # held while the model is in use, so it isn't unloaded
+        self.catch_up = set() # rooms whose state may be missing messages, from being routed elsewhere
+        self.unconfirmed = [] # the last messages added of each room, confirmed once a checkpoint holding them is written
+        self.seconds_per_room = None
+        self.load_seconds = None
+        self.last_used = time.monotonic()
+        self.stats = dict(loaded=False, loads=0, unloads=0, rooms=0, failures=0, catch_ups=0, seconds_per_room=0.0,
+                          streamed_events=0, streamed_tokens=0, stream_time=0.0, tokenize_time=0.0, stream_checkpoints=0)
+        metrics.collect('rwkv_lane', self.stats, model = name)
+        # labelled by model only, as a label per room would grow without bound; the tracer logs each message's room
+        self.reply_seconds = metrics.histogram('rwkv_reply_seconds', 'time from a message being queued to the end of its reply', ('model',))
+        self.first_text_seconds = metrics.histogram('rwkv_first_text_seconds', 'time from a message being queued to the first text of its reply', ('model',))
+        self.ingest_seconds = metrics.histogram('rwkv_ingest_seconds', 'time taken to add a room\'s queued messages to its state', ('model',))
+        self.batch_rooms = metrics.histogram('rwkv_batch_rooms', 'rooms replied to together', ('model',), buckets = (1, 2, 4, 8, 16, 32))
+        self.load_time = metrics.histogram('rwkv_load_seconds', 'time taken to load a model', ('model',))
+    def expected_wait(self):
+        # seconds a room routed here now can expect to wait: loading the model if it isn't, then the rooms ahead of it
+        wait = (self.incoming.rooms_held() + 1) * (self.seconds_per_room or 0)
+        if self.rwkv is None:
+            load_seconds = self.load_seconds
+            if load_seconds is None:
+                # a model not loaded yet is guessed to load as slowly as the slowest that has
+                known = [lane.load_seconds for lane in self.pool.lanes.values() if lane.load_seconds is not None]
+                load_seconds = max(known) if known else float('inf')
+            wait += load_seconds
+        return wait
+    def ensure_loaded(self):
+        # called with self.lock held
+        if self.rwkv is not None:
+            return
+        start = time.perf_counter()
+        with self.pool.lock:
+            self.pool.make_room(self)
+            self._use(self.given if self.load is None else self.load())
+            # again with the measured size, and for models that were busy before
+            if not self.pool.make_room(self):
+                logger.warning(f'{self.name} is loaded over the memory bound of {int(self.pool.memory_bound)} bytes, as the other models are in use')
+        self.load_seconds = time.perf_counter() - start
+        self.load_time.observe(self.load_seconds, model = self.name)
+        logger.info(f'loaded {self.name} in {self.load_seconds:.1f}s')
+    def unload(self):
+        # returns whether the model was unloaded, which it isn't while in use, with work queued, or if it can't be loaded again
+        if self.load is None or self.rwkv is None or not self.incoming.empty():
+            return False
+        if not self.lock.acquire(blocking=False):
+            return False
+        try:
+            if self.rwkv is None or not self.incoming.empty():
+                return False
+            rwkv, states = self.rwkv, self.states
+            states.save(rwkv.metadata)
+            rwkv.__exit__(None, None, None)
+            for model in (rwkv, getattr(rwkv, 'draft', None)):
+                if model is not None:
+                    model.checkpoints.close()
+                    metrics.discard(model.stats)
+                    metrics.discard(model.checkpoints.stats)
+            metrics.discard(states.stats)
+            self.rwkv = self.states = None
+            self.stats['loaded'] = False
+            self.stats['unloads'] += 1
+        finally:
+            self.lock.release()
+        del rwkv, states
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        logger.info(f'unloaded {self.name}')
+        return True
+    def _use(self, rwkv):
+        if self.pool.sampler is not None:
+            rwkv.sampler = self.pool.sampler
+        if type(rwkv.metadata) is not dict:
+            rwkv.metadata = {}
+        measured = weight_bytes(rwkv)
+        if measured is not None:
+            self.weight_bytes = measured
+        self.rwkv = rwkv
+        self.states = RoomStates(rwkv, memory_bound = self.pool.states_bound(self), system_prompt = self.pool.system_prompt, model = self.name)
+        self.stats['loaded'] = True
+        self.stats['loads'] += 1
+
+    def run(self):
+        while True:
+            # an idle lane that could load its model again gives it up after pool.idle seconds without work
+            idle = self.pool.idle if self.load is not None and self.rwkv is not None else None
+            msgs = self.incoming.get(timeout = idle)
+            if msgs is None:
+                self.unload()
+                continue
+            with self.lock:
+                start = time.perf_counter()
+                taken = [(msgs[-1].service, msgs[-1].room.name)]
+                try:
+                    self.ensure_loaded()
+                    # rooms waiting for a reply are gathered, up to batch_size, and their replies decoded together
+                    replies = []
+                    keys = set()
+                    while True:
+                        reply = self._ingest(msgs)
+                        if reply is not None:
+                            replies.append(reply)
+                            keys.add(taken[-1])
+                        if not replies or len(replies) >= self.pool.batch_size or not self.incoming.replying(keys):
+                            break
+                        msgs = self.incoming.get(keys)
+                        taken.append((msgs[-1].service, msgs[-1].room.name))
+                    if replies:
+                        self._reply(replies)
+                    if self.unconfirmed:
+                        unconfirmed, self.unconfirmed = self.unconfirmed, []
+                        self.states.save(self.rwkv.metadata, written = functools.partial(self._confirm, unconfirmed))
+                except Exception:
+                    # such as a request to the server or the inference worker failing; the lane goes on with the next rooms
+                    logger.exception(f'{self.name} failed handling {", ".join([room_name for service, room_name in taken])}')
+                    self.stats['failures'] += 1
+                finally:
+                    self.incoming.done(taken)
+                seconds_per_room = (time.perf_counter() - start) / len(taken)
+                self.seconds_per_room = seconds_per_room if self.seconds_per_room is None else self.seconds_per_room * 0.8 + seconds_per_room * 0.2
+                self.last_used = time.monotonic()
+                self.stats['rooms'] += len(taken)
+                self.stats['seconds_per_room'] = self.seconds_per_room
+    def _ingest(self, msgs):
+        # everything queued for one room is added in a single pass, reacting to only the last message, which is left in
+        # self.unconfirmed for run to confirm once the checkpoint holding it is written.
+        # returns (msg, thinking_id, (state, logits), state_path, arrival) if the room is to be replied to, with the reply's header added.
+        start = time.perf_counter()
+        arrival = self.incoming.arrival(msgs) or start
+        for queued in msgs:
+            metrics.tracer.stage(queued.id, 'prefill')
+        key = (msgs[-1].service, msgs[-1].room.name)
+        self.states.activate(msgs[-1].room)
+        if key in self.catch_up:
+            self.catch_up.discard(key)
+            traced = msgs
+            msgs = self._caught_up(msgs)
+            if not msgs:
+                for queued in traced:
+                    metrics.tracer.end(queued.id)
+                return None
+        msg = msgs[-1]
+        logger.debug(f'{self.name} adding {len(msgs)} messages from {msg.room.name}, {self.incoming.qsize()} more queued')
+        thinking_id = msg.service.react(msg, ':thinking_face:')
+        if len(msgs) > self.pool.stream_after:
+            self._stream(msgs[:-1])
+            msgs = msgs[-1:]
+        self.rwkv.metadata[msg.room.name] = msg.id
+        parts = []
+        for queued in msgs:
+            parts.append(Template(f'"{queued.sender}", in "{queued.room.name}", says:'))
+            parts.append(f' {queued.data}\n')
+        self.rwkv.add(parts, metadata = self.rwkv.metadata)
+        self.unconfirmed.append(msg)
+        for queued in msgs[:-1]:
+            metrics.tracer.end(queued.id)
+        if msg.sender == msg.service.user_id or not msg.room.voice:
+            msg.service.delete(msg.room, thinking_id)
+            metrics.tracer.end(msg.id)
+            self.ingest_seconds.observe(time.perf_counter() - start, model = self.name)
+            return None
+        self.rwkv.add(Template(f'"{msg.service.user_id}", in "{msg.room.name}", says:'), metadata = self.rwkv.metadata)
+        self.ingest_seconds.observe(time.perf_counter() - start, model = self.name)
+        return msg, thinking_id, self.rwkv.snapshot(), self.rwkv.state_path, arrival
+    @staticmethod
+    def _confirm(msgs):
+        # called by the checkpointer once the states holding msgs are written, so a restart resumes after them
+        for msg in msgs:
+            msg.service.confirm(msg)
+    def _stream(self, events):
+        # adds a long run of the active room's events, such as its history after the bot was offline.
+        # they are tokenized in a thread while the ones before are prefilled, and every pool.checkpoint_seconds the state
+        # is written with the id of the last event in it, which is then confirmed, so a restart continues from there.
+        room, service = events[-1].room, events[-1].service
+        start = time.perf_counter()
+        tokenized = queue.Queue(maxsize = 256)
+        def tokenize():
+            try:
+                for event in events:
+                    tokenize_start = time.perf_counter()
+                    ids = self.rwkv.encode(Template(f'"{event.sender}", in "{room.name}", says:')) + self.rwkv.encode(f' {event.data}\n')
+                    self.stats['tokenize_time'] += time.perf_counter() - tokenize_start
+                    tokenized.put((event, ids))
+                tokenized.put(None)
+            except Exception as exception:
+                tokenized.put(exception)
+        threading.Thread(target = tokenize, daemon = True).start()
+        state = self.rwkv.model.init_state
+        parts, count, last, saved = [], 0, None, time.monotonic()
+        while True:
+            item = tokenized.get()
+            if isinstance(item, Exception):
+                raise item
+            if item is not None:
+                event, ids = item
+                parts.append(ids)
+                count += len(ids)
+                last = event
+                # prefilled a few chunks at a time, while the tokenizer gets ahead again
+                if count < 512:
+                    continue
+            if parts:
+                logits, state = self.rwkv.advance(parts, state)
+                self.rwkv.model.init_logits, self.rwkv.model.init_state = logits, state
+                self.stats['streamed_events'] += len(parts)
+                self.stats['streamed_tokens'] += count
+                parts, count = [], 0
+                if time.monotonic() - saved >= self.pool.checkpoint_seconds:
+                    self.rwkv.metadata[room.name] = last.id
+                    self.rwkv.save(self.rwkv.metadata)
+                    self.rwkv.checkpoints.flush()
+                    service.confirm(last)
+                    self.stats['stream_checkpoints'] += 1
+                    saved = time.monotonic()
+            if item is None:
                 break
-        self.rwkv = RWKVModel(MODEL, 'state--' + MODEL)
-        if type(self.rwkv.metadata) is not dict:
-            self.rwkv.metadata = {}
-        self.incoming = queue.Queue()
+        self.rwkv.metadata[room.name] = last.id
+        elapsed = time.perf_counter() - start
+        self.stats['stream_time'] += elapsed
+        logger.info(f'{self.name} streamed {len(events)} events of {room.name} in {elapsed:.1f}s, {self.stats["streamed_events"] / self.stats["stream_time"]:.0f} events/s '
+                    f'and {self.stats["streamed_tokens"] / self.stats["stream_time"]:.0f} tokens/s so far')
+    def _caught_up(self, msgs):
+        # the room's messages since the last this model added, from its history, then any queued that aren't in it
+        room = msgs[-1].room
+        missed = edited_messages(room.history.after(self.rwkv.metadata.get(room.name)))
+        seen = set([event.id for event in missed])
+        missed.extend([msg for msg in msgs if msg.id not in seen and msg.id not in room.history])
+        self.stats['catch_ups'] += 1
+        return missed
+    def _reply(self, replies):
+        self.batch_rooms.observe(len(replies), model = self.name)
+        streams = []
+        for msg, thinking_id, start, key, arrival in replies:
+            msg.service.typing(msg.room, True, 10000)
+            metrics.tracer.stage(msg.id, 'decode')
+            streams.append(services.StreamingMessage(msg.room, interval = 1.0 if self.pool.stream else float('inf')))
+        starts = [start for msg, thinking_id, start, key, arrival in replies]
+        keys = [key for msg, thinking_id, start, key, arrival in replies]
+        started = set()
+        for index, text, end in self.rwkv.generate(starts, keys = keys):
+            msg, thinking_id, start, key, arrival = replies[index]
+            reply = streams[index]
+            if index not in started and text.strip():
+                started.add(index)
+                self.first_text_seconds.observe(time.perf_counter() - arrival, model = self.name)
+            if end is None:
+                msg.service.typing(msg.room, True, 10000)
+                reply.update(text)
+                if reply.id is not None and reply.id not in self.pool.already_processed:
+                    self.pool.already_processed.add(reply.id)
+                continue
+            reply.update(text)
+            reply.close()
+            msg.service.delete(msg.room, thinking_id)
+            send_id = reply.id
+            msg.service.typing(msg.room, False)
+            self.rwkv.metadata[msg.room.name] = send_id
+            self.pool.already_processed.add(send_id)
+            # the room's state continues from the end of its reply
+            self.states.activate(msg.room)
+            self.rwkv.model.init_state, self.rwkv.model.init_logits = end
+            self.reply_seconds.observe(time.perf_counter() - arrival, model = self.name)
+            metrics.tracer.end(msg.id)
+            logger.debug(f'{self.name} replied in {msg.room.name}: {text}')
+
+def edited_messages(events):
+    # the messages among events, each with the text of its latest edit among them.
+    # streamed replies are sent as their first word and then edited, so without this a room catching up would see fragments.
+    messages = []
+    positions = {}
+    for event in events:
+        if event.type == 'message':
+            positions[event.id] = len(messages)
+            messages.append(event)
+        elif event.type == 'edit' and event.reply in positions:
+            position = positions[event.reply]
+            edited = messages[position]
+            if edited.sender == event.sender:
+                messages[position] = services.Event(edited.service, edited.room, edited.id, edited.sender, edited.type, data = event.data, reply = edited.reply)
+    return messages
+
+def weight_bytes(rwkv):
+    # the bytes held by a loaded model's weights, or None if they aren't in this process
+    if not hasattr(rwkv.model, 'model'):
+        return None
+    total = 0
+    pending = [rwkv.model.model.w]
+    while pending:
+        w = pending.pop()
+        if type(w) is types.SimpleNamespace:
+            w = w.__dict__
+        if type(w) is dict:
+            pending.extend(w.values())
+        elif type(w) is Int8Weight:
+            total += w.nbytes
+        elif torch.is_tensor(w):
+            total += w.nelement() * w.element_size()
+    return total
+
+class RWKV:
+    # answers messages with one or more models sharing the memory bound. each model is a Lane serving its rooms.
+    # models can be names from MODELS, or a dict of name: function returning an RWKVModel; the first is the default and is
+    # loaded at once, the others when a room is first routed to them. without models, the largest model that fits is used.
+    # rooms named in routes always go to the named model. others stay with the model they were last routed to,
+    # moving to the model expected to answer soonest only when that's less than half the wait, and when they have nothing
+    # queued. a room moved to a model catches up on the messages it missed there when it next has a message.
+    # with idle, a model that could be loaded again is unloaded after idle seconds without work.
+    # at startup each room catches up on the history its state is missing. more than stream_after messages at once are
+    # streamed through Lane._stream, which checkpoints its progress every checkpoint_seconds.
+    def __init__(self, bot, stream = True, system_prompt = None, batch_size = 8, sampler = None, speculative = False, quantize = False, out_of_process = False, model = None, models = None, routes = None, idle = None, memory_bound = None, stream_after = 16, checkpoint_seconds = 5.0):
+        self.bot = bot
+        self.stream = stream
+        self.system_prompt = system_prompt
+        self.batch_size = batch_size
+        self.sampler = sampler
+        self.speculative = speculative
+        self.quantize = quantize
+        self.out_of_process = out_of_process
+        self.routes = routes or {}
+        self.idle = idle
+        self.stream_after = stream_after
+        self.checkpoint_seconds = checkpoint_seconds
+        self.memory_bound = probe_memory() if memory_bound is None else memory_bound
+        self.lock = threading.Lock() # held while loading a model
+        self.assigned = {} # (service, room name): lane
         self.already_processed = set()
-        self.start()
+        self.stats = dict(routed=0, moved=0)
+        metrics.collect('rwkv_pool', self.stats)
+        self.lanes = {}
+        if model is not None:
+            # an RWKVModel made by the caller, such as a small one for benchmarks
+            self.lanes[os.path.basename(model.model_path)] = Lane(self, os.path.basename(model.model_path), rwkv = model)
+        if models is None and model is None:
+            models = [self._largest()]
+        if type(models) is dict:
+            for name, load in models.items():
+                self.lanes[name] = Lane(self, name, load)
+        else:
+            for name in models or ():
+                self.lanes[name] = Lane(self, name, functools.partial(self._make, name), self._estimate(name))
+        self.default = next(iter(self.lanes.values()))
+        with self.default.lock:
+            self.default.ensure_loaded()
+        for lane in self.lanes.values():
+            lane.start()
         for service in self.bot.services:
             for room in service.rooms.values():
-                metadata = self.rwkv.metadata.get(room.name)
-                history = room.history
-                start_idx = 0
-                for idx, event in enumerate(history):
-                    if event.id == metadata:
-                        start_idx = idx + 1
-                for event in history[start_idx:]:
-                    if event.id not in self.already_processed:
-                        self.already_processed.add(event.id)
-                        self.incoming.put(event)
+                lane = self.route(room)
+                if lane.rwkv is None:
+                    # caught up on the room's next message
+                    continue
+                # the shared metadata is never ahead of the rooms' own states, so a room it is up to date for is.
+                # otherwise the room's newest message is queued, and the lane adds everything from where the room's state got to.
+                missed = edited_messages(room.history.after(lane.rwkv.metadata.get(room.name)))
+                if missed:
+                    self.already_processed.update([event.id for event in missed])
+                    lane.catch_up.add((service, room.name))
+                    # confirmed by the lane like other queued messages, holding back those handled after it
+                    if hasattr(service, 'defer'):
+                        service.defer(missed[-1])
+                    lane.incoming.put(missed[-1])
+    def __exit__(self, exc_t, exc_v, exc_tb):
+        for lane in self.lanes.values():
+            with lane.lock:
+                if lane.rwkv is not None:
+                    lane.states.save(lane.rwkv.metadata)
+                    lane.rwkv.__exit__(exc_t, exc_v, exc_tb)
     def on_message(self, msg):
         if msg.type != 'message':
             return
@@ -134,59 +1284,79 @@ class RWKV(threading.Thread):
             if msg.id in self.already_processed:
                 self.already_processed.remove(msg.id)
                 return
-        self.incoming.put(msg)
-    def run(self):
-        while True:
-            msg = self.incoming.get()
-            progress = tqdm.tqdm(self.incoming.qsize() + 1, leave=False)
-            # the first item used to be separated out here,
-            # so that the loop condition could be in the while statement.
-            # doing that again would make it easier to use a context for the thinking emoji.
-            progress.n = 0
-            while True:
-                progress.set_description(f'{msg.sender}: {msg.data}')
-                self.rwkv.metadata[msg.room.name] = msg.id
-                thinking_id = msg.service.react(msg, ':thinking_face:')
-                self.rwkv.add(f'"{msg.sender}", in "{msg.room.name}", says: {msg.data}\n', metadata = self.rwkv.metadata)
-                msg.service.confirm(msg)
-                progress.n += 1
-                if self.incoming.empty():
-                    break
-                else:
-                    msg.service.delete(msg.room, thinking_id)
-                progress.total = progress.n + self.incoming.qsize()
-                msg = self.incoming.get()
-            if msg.sender == msg.service.user_id or not msg.room.voice:
-                progress.close()
-                msg.service.delete(msg.room, thinking_id)
-                continue
-            progress.refresh()
-            self.rwkv.add(f'"{msg.service.user_id}", in "{msg.room.name}", says:', metadata = self.rwkv.metadata)
-            progress.close()
-            progress = tqdm.tqdm(leave=False, total=128)
-            progress.n = 0
-            text = ''
-            msg.service.typing(msg.room, True, 10000)
-            for token in self.rwkv:
-                msg.service.typing(msg.room, True, 10000)
-                if not text:
-                    token = token.lstrip()
-                if token == '\n':
-                    break
-                assert '\n' not in token
-                text += token
-                if len(text) >= 256:
-                    text += ' ...'
-                    break
-                progress.n += 1
-                progress.set_description(text)
-            progress.close()
-            msg.service.delete(msg.room, thinking_id)
-            send_id = msg.service.send(msg.room, text)
-            msg.service.typing(msg.room, False)
-            self.rwkv.metadata[msg.room.name] = send_id
-            self.already_processed.add(send_id)
-            self.rwkv.save(metadata=self.rwkv.metadata)
+        metrics.tracer.stage(msg.id, 'queue')
+        # confirmed by the lane once added to the room's state
+        if hasattr(msg.service, 'defer'):
+            msg.service.defer(msg)
+        self.route(msg.room).incoming.put(msg)
+
+    def route(self, room):
+        key = (room.service, room.name)
+        current = self.assigned.get(key)
+        lane = self.lanes.get(self.routes.get(room.name))
+        if lane is None:
+            lane = current or self.default
+            if not lane.incoming.holds(key):
+                best = min(self.lanes.values(), key = Lane.expected_wait)
+                if best.expected_wait() * 2 < lane.expected_wait():
+                    lane = best
+        if lane is not current:
+            if current is not None and current.incoming.holds(key):
+                # moved once its messages there are done, so they are answered in order
+                return current
+            if current is not None or lane is not self.default:
+                lane.catch_up.add(key)
+                self.stats['moved'] += current is not None
+            self.assigned[key] = lane
+        self.stats['routed'] += 1
+        return lane
+    def make_room(self, lane):
+        # unloads the least recently used idle models until lane's weights fit with the other loaded ones,
+        # returning whether they do. called with self.lock held.
+        loaded = [other for other in self.lanes.values() if other.rwkv is not None and other is not lane]
+        needed = sum([other.weight_bytes or 0 for other in loaded]) + (lane.weight_bytes or 0)
+        for other in sorted(loaded, key = lambda other: other.last_used):
+            if needed <= self.memory_bound:
+                break
+            if other.unload():
+                needed -= other.weight_bytes or 0
+        return needed <= self.memory_bound
+    def states_bound(self, lane):
+        # half the memory left by the loaded weights holds room states, shared evenly by all the lanes
+        loaded = sum([other.weight_bytes or 0 for other in self.lanes.values() if other.rwkv is not None or other is lane])
+        return (self.memory_bound - loaded) / 2 / len(self.lanes)
+
+    def _largest(self):
+        # the largest model that fits, with its draft if speculative
+        for name in MODELS:
+            if self.memory_bound > self._estimate(name):
+                return name
+        return name
+    def _estimate(self, name):
+        # the bytes of a model's weights, replaced by its measured size once loaded: bf16 on cuda, fp32 on cpu, and int8
+        # with a scale per row on cpu with quantize. the checkpoint is converted a weight at a time from a memory map
+        # and the converted weights are mapped from their cache, so loading holds no more than that.
+        _imports()
+        param_count = MODELS.get(name, 0)
+        if self._drafted(name):
+            param_count += MODELS[DRAFT]
+        cuda = torch.cuda.is_available()
+        if self.quantize and not cuda:
+            return param_count * 1.01
+        return param_count * (2 if cuda else 4)
+    def _drafted(self, name):
+        # whether the model gets a draft: with speculative, if it is at least 8 times the draft's size, as smaller ones
+        # verify too slowly to gain from one
+        return self.speculative and MODELS.get(name, 0) >= 8 * MODELS[DRAFT]
+    def _make(self, name):
+        if self.out_of_process:
+            # forward passes run in a worker process that can be restarted, while room states stay here in shared memory
+            import inference_worker
+            return inference_worker.RemoteModel(name, 'state--' + name, draft_path = DRAFT if self._drafted(name) else None, quantize = self.quantize)
+        draft = None
+        if self._drafted(name):
+            draft = RWKVModel(DRAFT, 'state--' + DRAFT, quantize = self.quantize)
+        return RWKVModel(name, 'state--' + name, draft = draft, quantize = self.quantize)
 
 if __name__ == '__main__':
     #print('17: After the quick brown fox', end='', flush=True)
@@ -0,0 +1,116 @@
+##### A pool of worker processes, started ahead of time, for running untrusted or expensive functions such as !eval.
+##### Each call is limited in cpu time and the workers in memory, and a call taking longer than its timeout has its worker
+#####  killed and replaced, so one bad call can't hold up the bot or the calls behind it for long.
+##### Results are passed to callbacks from the pool's threads, so submitting a call never waits for it.
+
+import logging, multiprocessing, psutil, queue, resource, threading
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+class SandboxTimeout(Exception):
+    pass
+
+class SandboxError(Exception):
+    # a call failed in its worker; the message is the worker's exception, as the exception itself may not pickle
+    pass
+
+class Sandbox:
+    def __init__(self, workers = 2, timeout = 5.0, cpu_seconds = 5, memory_bytes = 512 * 2**20):
+        self.timeout = timeout
+        self.cpu_seconds = cpu_seconds
+        self.memory_bytes = memory_bytes
+        methods = multiprocessing.get_all_start_methods()
+        # workers are forked from a small server process rather than the bot, which may hold a model and threads
+        self.context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+        self.calls = queue.Queue()
+        self.lock = threading.Lock() # for stats, updated by every slot's thread
+        self.stats = dict(calls=0, timeouts=0, errors=0, restarts=0)
+        metrics.collect('sandbox', self.stats)
+        self.slots = [_Slot(self) for idx in range(workers)]
+        for slot in self.slots:
+            slot.start()
+    def submit(self, func, params, callback):
+        # calls func(*params) in a worker, then callback(result, error) with error None, a SandboxError or a SandboxTimeout.
+        # func must be importable by name, as it is sent to the worker by reference.
+        self.calls.put((func, params, callback))
+    def stop(self):
+        for slot in self.slots:
+            self.calls.put(None)
+        for slot in self.slots:
+            slot.join()
+
+class _Slot(threading.Thread):
+    # a thread that feeds one worker process its calls, replacing the process when it times out or dies
+    def __init__(self, sandbox):
+        super().__init__(daemon=True)
+        self.sandbox = sandbox
+        self.process = None
+    def _spawn(self):
+        # waits for the worker to be ready, so starting it, which imports the main module, doesn't count toward a call's timeout
+        if self.process is not None:
+            self.process.kill()
+            self.process.join()
+        self.connection, child = self.sandbox.context.Pipe()
+        self.process = self.sandbox.context.Process(target=_work, args=(child, self.sandbox.cpu_seconds, self.sandbox.memory_bytes), daemon=True)
+        self.process.start()
+        child.close()
+        self.connection.recv()
+    def run(self):
+        sandbox = self.sandbox
+        self._spawn()
+        while True:
+            call = sandbox.calls.get()
+            if call is None:
+                self.process.kill()
+                return
+            func, params, callback = call
+            with sandbox.lock:
+                sandbox.stats['calls'] += 1
+            try:
+                self.connection.send((func, params))
+                if self.connection.poll(sandbox.timeout):
+                    ok, result = self.connection.recv()
+                    error = None if ok else SandboxError(result)
+                    result = result if ok else None
+                else:
+                    result, error = None, SandboxTimeout(f'timed out after {sandbox.timeout}s')
+            except (EOFError, OSError):
+                # the worker died, most likely from its cpu limit
+                result, error = None, SandboxTimeout(f'exceeded {sandbox.cpu_seconds}s of cpu time')
+            if error is not None:
+                with sandbox.lock:
+                    sandbox.stats['timeouts' if type(error) is SandboxTimeout else 'errors'] += 1
+            try:
+                callback(result, error)
+            except Exception:
+                logger.exception('sandbox callback failed')
+            if type(error) is SandboxTimeout:
+                # after answering, as a new worker takes a moment to start
+                with sandbox.lock:
+                    sandbox.stats['restarts'] += 1
+                self._spawn()
+
+def _work(connection, cpu_seconds, memory_bytes):
+    # memory_bytes beyond what the worker maps once started, which includes whatever the main module imports, such as torch
+    soft, hard = resource.getrlimit(resource.RLIMIT_AS)
+    if memory_bytes is not None:
+        limit = psutil.Process().memory_info().vms + memory_bytes
+        resource.setrlimit(resource.RLIMIT_AS, (limit if hard == resource.RLIM_INFINITY else min(limit, hard), hard))
+    connection.send(None)
+    while True:
+        try:
+            func, params = connection.recv()
+        except EOFError:
+            return
+        # the cpu limit is cumulative, so each call's limit is counted from what the worker has used so far
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        used = int(usage.ru_utime + usage.ru_stime) + 1
+        soft, hard = resource.getrlimit(resource.RLIMIT_CPU)
+        resource.setrlimit(resource.RLIMIT_CPU, (used + cpu_seconds, hard))
+        try:
+            result = (True, func(*params))
+        except BaseException as exception:
+            result = (False, f'{type(exception).__name__}: {exception}')
+        connection.send(result)
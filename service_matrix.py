@@ -10,34 +10,157 @@
 from matrix_bot_api.matrix_bot_api import MatrixBotAPI
 from matrix_bot_api.mregex_handler import MRegexHandler
 from matrix_bot_api.mcommand_handler import MCommandHandler
-from matrix_client.api import quote # for shims
+from matrix_client.api import MatrixHttpApi, quote # for shims
+from matrix_client.client import MatrixClient
 
-import emoji
+import emoji, logging, re
 
-import services
+import metrics, services
+
+_event_types = {
+    'm.room.message': 'message',
+    'm.room.member': 'membership',
+    'm.reaction': 'reaction',
+}
+
+_calls = [
+    (re.compile(pattern), call) for pattern, call in [
+        (r'^/sync', 'sync'),
+        (r'^/rooms/[^/]+/send/m\.reaction/', 'react'),
+        (r'^/rooms/[^/]+/send/', 'send'),
+        (r'^/rooms/[^/]+/redact/', 'redact'),
+        (r'^/rooms/[^/]+/typing/', 'typing'),
+        (r'^/rooms/[^/]+/read_markers', 'read_markers'),
+        (r'^/login', 'login'),
+        (r'^/join/', 'join'),
+    ]
+]
+request_seconds = metrics.histogram('matrix_request_seconds', 'time taken by each request to the homeserver', ('call',))
+request_errors = metrics.counter('matrix_request_errors_total', 'requests to the homeserver that failed', ('call',))
+
+def call_name(path):
+    # what a client-server api request does, to label its metrics
+    for pattern, call in _calls:
+        if pattern.match(path):
+            return call
+    return 'other'
+
+def _timed(api):
+    # wraps api._send, which every request of a MatrixHttpApi goes through, to time the requests
+    send = api._send
+    def timed_send(method, path, *params, **kwparams):
+        call = call_name(path)
+        try:
+            with request_seconds.time(call=call):
+                return send(method, path, *params, **kwparams)
+        except Exception:
+            request_errors.inc(call=call)
+            raise
+    api._send = timed_send
+    return api
+
+def _decode_event(event_raw):
+    # returns the data and reply of a services.Event from a raw matrix event
+    content = event_raw['content']
+    if 'm.relates_to' in content:
+        if 'm.in_reply_to' in content['m.relates_to']:
+            reply_id = content['m.relates_to']['m.in_reply_to']['event_id']
+        else:
+            reply_id = content['m.relates_to']['event_id']
+    elif 'redacts' in event_raw:
+        # type == m.redaction
+        reply_id = event_raw['redacts']
+    else:
+        reply_id = None
+    data = None
+    if event_raw['type'] == 'm.room.message' and 'm.new_content' in content:
+        data = content['m.new_content'].get('body')
+    elif event_raw['type'] == 'm.room.message':
+        data = content['body'] if content else None
+    elif event_raw['type'] == 'm.room.member':
+        data = content['membership'] if content else None
+    elif event_raw['type'] == 'm.reaction':
+        # note: emoji reactions are i think technically any message with m.relates_to.rel_type=m.annotation
+        #if 'm.relates_to' not in event_raw['content']:
+        data = content['m.relates_to']['key'] if content else None
+    else:
+        data = f"{event_raw['type']}: {repr(content)}"
+    if type(data) is str:
+        data = emoji.demojize(data)
+    return data, reply_id
 
 class MatrixRoom(services.Room):
     def __init__(self, service, room):
-        super().__init__(service, service._room2name(room), not room.guest_access, raw=room)
-    @property
-    def history(self):
-        return [self.service._matrix2event(self.raw, event_raw) for event_raw in self.raw.events]
-    @history.setter
-    def history(self, ignored_content):
-        pass
+        super().__init__(service, service._room2name(room), not room.guest_access, history=services.History(service.history_window), raw=room)
+        # events from before the room was seen; later ones are appended by handle_message
+        for event_raw in room.events:
+            event = service._matrix2event(room, event_raw, self)
+            self.history.append(event)
+            if service.sync_state is not None:
+                service.sync_state.receive(event)
 
 class Matrix(MatrixBotAPI):
-    def __init__(self, handler, username, password, server):
+    history_window = 1024
+    sync_state = None
+    def __init__(self, handler, username, password, server, sync_path = None):
         self.handler = handler
-        # Create an instance of the MatrixBotAPI
-        super().__init__(username, password, server)
+        if sync_path is None:
+            # Create an instance of the MatrixBotAPI
+            super().__init__(username, password, server)
+        else:
+            self._resume(username, password, server, sync_path)
         self.user_id = self.client.user_id
+        _timed(self.client.api)
+        # typing, reactions, redactions and read markers go through an outbox with its own connection pool.
+        # its transaction ids are offset so they can't collide with those of the sync client.
+        self.outbound_api = _timed(MatrixHttpApi(self.client.api._base_url, token=self.client.api.token))
+        self.outbound_api.txn_id = 1 << 32
+        self.outbox = services.Outbox(self)
         self.rooms = {}
         self.rooms = {
             self._room2name(room): MatrixRoom(self, room)
             for room in self.client.get_rooms().values()
             if not room.guest_access
         }
+        if self.sync_state is not None:
+            self.sync_state.end(self.client.sync_token)
+            self.client._sync = self._sync
+
+    def _resume(self, username, password, server, sync_path):
+        # what MatrixBotAPI.__init__ does, but the first sync continues from the saved token if there is one.
+        # rooms are made from their saved names, as an incremental sync only has the state that changed.
+        self.username = username
+        self.client = MatrixClient(server)
+        self.client.login(username, password, sync=False)
+        self.sync_state = services.SyncState(sync_path, self.client.user_id)
+        # syncs return up to history_window events of each room, and rooms keep them, so a bot that was away can catch up
+        self.client.sync_filter = '{ "room": { "timeline" : { "limit" : %i } } }' % self.history_window
+        mkroom = self.client._mkroom
+        def _mkroom(room_id):
+            room = mkroom(room_id)
+            room.event_history_limit = self.history_window
+            return room
+        self.client._mkroom = _mkroom
+        if self.sync_state.since is not None:
+            self.client.sync_token = self.sync_state.since
+            for room_id, (name, guest_access) in self.sync_state.rooms.items():
+                room = self.client._mkroom(room_id)
+                room.name = name
+                room.guest_access = guest_access
+        self.sync_state.begin(self.client.sync_token)
+        MatrixClient._sync(self.client, timeout_ms=0)
+        self.handlers = []
+        self.client.add_invite_listener(self.handle_invite)
+        self.rooms = []
+        for room_id, room in self.client.get_rooms().items():
+            room.add_listener(self.handle_message)
+
+    def _sync(self, timeout_ms = 30000):
+        # the client's sync, with its events marked as one batch of the sync state
+        self.sync_state.begin(self.client.sync_token)
+        MatrixClient._sync(self.client, timeout_ms)
+        self.sync_state.end(self.client.sync_token)
+        self.sync_state.save(self.client.rooms)
    
     @staticmethod
     def _room2name(room):
@@ -53,21 +176,62 @@ class Matrix(MatrixBotAPI):
         result = room.raw.send_text(message)
         return result['event_id']
 
+    def edit(self, room, event_id, message):
+        message = emoji.emojize(message)
+        result = self.client.api.send_message_event(
+                room.raw.room_id,
+                'm.room.message',
+                {
+                    'msgtype': 'm.text',
+                    'body': '* ' + message,
+                    'm.new_content': {'msgtype': 'm.text', 'body': message},
+                    'm.relates_to': dict(event_id=event_id, rel_type='m.replace'),
+                },
+            )
+        return result['event_id']
+
     def typing(self, room, flag = True, timeout = None):
-        self._send_typing(room.raw.room_id, flag, timeout)
+        self.outbox.typing(room, flag, timeout)
 
     def delete(self, room, event_id):
+        self.outbox.delete(room, event_id)
+
+    def confirm(self, event):
+        if self.sync_state is not None:
+            self.sync_state.confirm(event)
+        self.outbox.confirm(event)
+
+    def defer(self, event):
+        # called by a module handling event that will confirm it later, once it is processed
+        if self.sync_state is not None:
+            self.sync_state.defer(event)
+
+    def handled(self, event):
+        # called once event's handlers have run
+        if self.sync_state is not None:
+            self.sync_state.handled(event)
+
+    def react(self, event, reaction):
+        # returns a services.Pending whose id is filled in once the reaction is sent
+        return self.outbox.react(event, reaction)
+
+    # blocking implementations used by the outbox
+
+    def _typing(self, room, flag = True, timeout = None):
+        self._send_typing(room.raw.room_id, flag, timeout)
+
+    def _delete(self, room, event_id):
         if event_id is not None:
-            result = room.raw.redact_message(event_id)
+            result = self.outbound_api.redact_event(room.raw.room_id, event_id)
             return result['event_id']
     
-    def confirm(self, event):
+    def _confirm(self, event):
         self._send_read_markers(event.room.raw.room_id, event.id, event.id) # returns empty dict
 
-    def react(self, event, reaction):
+    def _react(self, event, reaction):
         reaction = emoji.emojize(reaction)
         try:
-            result = self.client.api.send_message_event(
+            result = self.outbound_api.send_message_event(
                     event.room.raw.room_id,
                     'm.reaction',
                     {'m.relates_to': dict(event_id=event.id, key=reaction, rel_type='m.annotation')},
@@ -77,48 +241,32 @@ class Matrix(MatrixBotAPI):
             return None
 
 
-    def _matrix2event(self, room_raw, event_raw):
+    def _matrix2event(self, room_raw, event_raw, room = None):
+        # data and reply are decoded from event_raw by _decode_event only when a module uses them
         event_id = event_raw['event_id']
         sender = event_raw['sender']
         room_name = self._room2name(room_raw)
-        services.logger.debug(f'{room_name} {repr(event_raw)}')
-        if room_name in self.rooms:
+        if services.logger.isEnabledFor(logging.DEBUG):
+            services.logger.debug(f'{room_name} {repr(event_raw)}')
+        if room is not None:
+            pass
+        elif room_name in self.rooms:
             room = self.rooms[room_name]
             room.raw = room_raw
         else:
             room = MatrixRoom(self, room_raw)
             self.rooms[room_name] = room
-        if 'm.relates_to' in event_raw['content']:
-            if 'm.in_reply_to' in event_raw['content']['m.relates_to']:
-                reply_id = event_raw['content']['m.relates_to']['m.in_reply_to']['event_id']
-            else:
-                reply_id = event_raw['content']['m.relates_to']['event_id']
-        elif 'redacts' in event_raw:
-            # type == m.redaction
-            reply_id = event_raw['redacts']
-        else:
-            reply_id = None
-        data = None
-        if event_raw['type'] == 'm.room.message':
-            data = event_raw['content']['body'] if event_raw['content'] else None
-            etype = 'message'
-        elif event_raw['type'] == 'm.room.member':
-            data = event_raw['content']['membership'] if event_raw['content'] else None
-            etype = 'membership'
-        elif event_raw['type'] == 'm.reaction':
-            # note: emoji reactions are i think technically any message with m.relates_to.rel_type=m.annotation
-            #if 'm.relates_to' not in event_raw['content']:
-            data = event_raw['content']['m.relates_to']['key'] if event_raw['content'] else None
-            etype = 'reaction'
-        else:
-            data = f"{event_raw['type']}: {repr(event_raw['content'])}"
-            etype = 'other'
-        if type(data) is str:
-            data = emoji.demojize(data)
-        return services.Event(self, room, event_id, sender, etype, data=data, raw=event_raw, reply=reply_id)
+        etype = _event_types.get(event_raw['type'], 'other')
+        if etype == 'message' and 'm.new_content' in event_raw['content']:
+            # m.replace edit of an earlier message, reply is the edited message
+            etype = 'edit'
+        return services.Event(self, room, event_id, sender, etype, raw=event_raw, decode=_decode_event)
 
     def handle_message(self, room_raw, event_raw):
         event = self._matrix2event(room_raw, event_raw)
+        event.room.history.append(event)
+        if self.sync_state is not None:
+            self.sync_state.receive(event)
         self.handler._on_event(event)
 
     def handle_invite(self, room_id, state):
@@ -147,7 +295,9 @@ class Matrix(MatrixBotAPI):
     def stop(self):
         #self.client.stop_listener_thread() # cannot join current thread
         self.client.should_listen = False
-        
+        if self.sync_state is not None:
+            self.sync_state.save(self.client.rooms, force = True)
+
 
     # read markers from https://github.com/matrix-org/matrix-python-sdk/pull/301
     def _send_read_markers(self, room_id, mfully_read, mread=None):
@@ -164,7 +314,7 @@ class Matrix(MatrixBotAPI):
              content['m.read'] = mread
 
          path = "/rooms/{}/read_markers".format(quote(room_id))
-         return self.client.api._send("POST", path, content)
+         return self.outbound_api._send("POST", path, content)
 
     # typing styled after read markers
     def _send_typing(self, room_id, typing : bool, timeout : int = None):
@@ -177,4 +327,4 @@ class Matrix(MatrixBotAPI):
          if timeout:
             content['timeout'] = timeout
          path = "/rooms/{}/typing/{}".format(quote(room_id), quote(self.user_id))
-         return self.client.api._send("PUT", path, content)
+         return self.outbound_api._send("PUT", path, content)
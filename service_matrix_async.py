@@ -0,0 +1,282 @@
+##### An asyncio implementation of the matrix service, talking to the client-server api directly with aiohttp.
+##### It has the same interface as service_matrix.Matrix, so modules don't need to know which one they use,
+#####  but all instances share one event loop thread and each keeps a pool of connections,
+#####  so syncing, sending and the outbox's requests for many rooms and accounts run concurrently.
+##### Event handlers run in order on a separate thread, so they can still make blocking calls back into the service.
+
+import asyncio, concurrent.futures, itertools, threading, time, urllib.parse
+
+import aiohttp
+import emoji
+
+import services, service_matrix
+
+_loop = None
+_loop_lock = threading.Lock()
+
+def event_loop():
+    # the loop shared by all AsyncMatrix instances, started on first use
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, daemon=True).start()
+    return _loop
+
+class MatrixRequestError(Exception):
+    def __init__(self, code, content):
+        super().__init__(f'{code}: {content}')
+        self.code = code
+        self.content = content
+
+class RawRoom:
+    # the parts of matrix_client.room.Room that MatrixRoom and _matrix2event use
+    event_history_limit = 20
+    def __init__(self, room_id):
+        self.room_id = room_id
+        self.name = None
+        self.guest_access = False
+        self.events = []
+    def _put_event(self, event):
+        self.events.append(event)
+        if len(self.events) > self.event_history_limit:
+            self.events.pop(0)
+    def _process_state_event(self, event):
+        if event['type'] == 'm.room.name':
+            self.name = event['content'].get('name')
+        elif event['type'] == 'm.room.guest_access':
+            self.guest_access = event['content'].get('guest_access') == 'can_join'
+
+class AsyncMatrix:
+    api_path = '/_matrix/client/r0'
+    history_window = 1024
+    sync_state = None
+    def __init__(self, handler, username, password, server, connections = 16, sync_path = None):
+        self.handler = handler
+        self.server = server.rstrip('/')
+        self.connections = connections
+        self.loop = event_loop()
+        self.token = None
+        self.since = None
+        self.txn_ids = itertools.count(1) # next() on it is atomic, as ids are taken from the loop and outbox threads
+        self.raw_rooms = {}
+        self.rooms = {}
+        self.should_listen = True
+        self.listener = None
+        self.dispatcher = concurrent.futures.ThreadPoolExecutor(1)
+        self._call(self._login(username, password))
+        if sync_path is not None:
+            # the first sync continues from the saved token, with rooms made from their saved names,
+            # as an incremental sync only has the state that changed
+            self.sync_state = services.SyncState(sync_path, self.user_id)
+            self.since = self.sync_state.since
+            for room_id, (name, guest_access) in self.sync_state.rooms.items():
+                room_raw = RawRoom(room_id)
+                room_raw.name = name
+                room_raw.guest_access = guest_access
+                room_raw.event_history_limit = self.history_window
+                self.raw_rooms[room_id] = room_raw
+        self._call(self._sync(timeout_ms = 0, dispatch = False))
+        self.outbox = services.Outbox(self)
+
+    _room2name = staticmethod(service_matrix.Matrix._room2name)
+    _matrix2event = service_matrix.Matrix._matrix2event
+
+    def send(self, room, message):
+        return self._call(self._send_event(room.raw.room_id, 'm.room.message', {'msgtype': 'm.text', 'body': emoji.emojize(message)}))
+
+    def edit(self, room, event_id, message):
+        message = emoji.emojize(message)
+        return self._call(self._send_event(room.raw.room_id, 'm.room.message', {
+            'msgtype': 'm.text',
+            'body': '* ' + message,
+            'm.new_content': {'msgtype': 'm.text', 'body': message},
+            'm.relates_to': dict(event_id=event_id, rel_type='m.replace'),
+        }))
+
+    def typing(self, room, flag = True, timeout = None):
+        self.outbox.typing(room, flag, timeout)
+
+    def delete(self, room, event_id):
+        self.outbox.delete(room, event_id)
+
+    def confirm(self, event):
+        if self.sync_state is not None:
+            self.sync_state.confirm(event)
+        self.outbox.confirm(event)
+
+    def defer(self, event):
+        # called by a module handling event that will confirm it later, once it is processed
+        if self.sync_state is not None:
+            self.sync_state.defer(event)
+
+    def handled(self, event):
+        # called once event's handlers have run
+        if self.sync_state is not None:
+            self.sync_state.handled(event)
+
+    def react(self, event, reaction):
+        return self.outbox.react(event, reaction)
+
+    # used by the outbox, which runs them in order on its own thread, so each waits for its request to finish.
+    # otherwise typing notices could arrive reversed and read markers move backwards.
+
+    def _typing(self, room, flag = True, timeout = None):
+        content = {'typing': flag}
+        if timeout:
+            content['timeout'] = timeout
+        self._call(self._request('PUT', f'/rooms/{self._quote(room.raw.room_id)}/typing/{self._quote(self.user_id)}', content))
+
+    def _delete(self, room, event_id):
+        self._call(self._request('PUT', f'/rooms/{self._quote(room.raw.room_id)}/redact/{self._quote(event_id)}/{self._txn_id()}', {}))
+
+    def _confirm(self, event):
+        self._call(self._request('POST', f'/rooms/{self._quote(event.room.raw.room_id)}/read_markers', {'m.fully_read': event.id, 'm.read': event.id}))
+
+    def _react(self, event, reaction):
+        try:
+            return self._call(self._send_event(event.room.raw.room_id, 'm.reaction', {
+                'm.relates_to': dict(event_id=event.id, key=emoji.emojize(reaction), rel_type='m.annotation')
+            }))
+        except MatrixRequestError:
+            return None
+
+    def handle_message(self, room_raw, event_raw):
+        event = self._matrix2event(room_raw, event_raw)
+        event.room.history.append(event)
+        if self.sync_state is not None:
+            self.sync_state.receive(event)
+        self.handler._on_event(event)
+
+    def start(self):
+        self.listener = self._spawn(self._listen())
+
+    def wait(self):
+        self.listener.result()
+
+    def stop(self):
+        self.should_listen = False
+        if self.sync_state is not None:
+            self.sync_state.save(self.raw_rooms, force = True)
+
+    def _call(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def _spawn(self, coroutine):
+        future = asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+        future.add_done_callback(self._log_failure)
+        return future
+
+    @staticmethod
+    def _log_failure(future):
+        if not future.cancelled() and future.exception() is not None:
+            services.logger.error(f'matrix request failed: {future.exception()!r}')
+
+    @staticmethod
+    def _quote(text):
+        return urllib.parse.quote(text, safe='')
+
+    def _txn_id(self):
+        return f'{id(self)}.{next(self.txn_ids)}'
+
+    async def _request(self, method, path, content = None, params = None):
+        headers = {}
+        if self.token is not None:
+            headers['Authorization'] = 'Bearer ' + self.token
+        call = service_matrix.call_name(path)
+        while True:
+            start = time.perf_counter()
+            try:
+                async with self.session.request(method, self.server + self.api_path + path, json=content, params=params, headers=headers) as response:
+                    try:
+                        result = await response.json(content_type=None)
+                    except ValueError:
+                        # not json, such as a proxy's error page
+                        service_matrix.request_errors.inc(call=call)
+                        raise MatrixRequestError(response.status, await response.text(errors='replace'))
+            except asyncio.TimeoutError as exception:
+                service_matrix.request_errors.inc(call=call)
+                raise MatrixRequestError(None, 'timed out') from exception
+            except aiohttp.ClientError:
+                service_matrix.request_errors.inc(call=call)
+                raise
+            service_matrix.request_seconds.observe(time.perf_counter() - start, call=call)
+            if response.status == 429:
+                await asyncio.sleep(result.get('retry_after_ms', 5000) / 1000)
+                continue
+            if response.status >= 400:
+                service_matrix.request_errors.inc(call=call)
+                raise MatrixRequestError(response.status, result)
+            return result
+
+    async def _login(self, username, password):
+        self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.connections))
+        result = await self._request('POST', '/login', {
+            'type': 'm.login.password',
+            'identifier': {'type': 'm.id.user', 'user': username},
+            'user': username,
+            'password': password,
+        })
+        self.token = result['access_token']
+        self.user_id = result['user_id']
+
+    async def _send_event(self, room_id, event_type, content):
+        result = await self._request('PUT', f'/rooms/{self._quote(room_id)}/send/{self._quote(event_type)}/{self._txn_id()}', content)
+        return result['event_id']
+
+    async def _listen(self):
+        while self.should_listen:
+            try:
+                await self._sync()
+            except (aiohttp.ClientError, MatrixRequestError) as exception:
+                services.logger.error(f'matrix sync failed: {exception!r}')
+                await asyncio.sleep(5)
+
+    async def _sync(self, timeout_ms = 30000, dispatch = True):
+        # up to history_window events of each room, which rooms keep, so a bot that was away can catch up
+        params = {'timeout': str(timeout_ms), 'filter': '{ "room": { "timeline" : { "limit" : %i } } }' % self.history_window}
+        if self.since is not None:
+            params['since'] = self.since
+        response = await self._request('GET', '/sync', params=params)
+        if self.sync_state is not None:
+            # events are handled on the dispatcher thread, so the batch is marked there too
+            if dispatch:
+                self.dispatcher.submit(self.sync_state.begin, self.since)
+            else:
+                self.sync_state.begin(self.since)
+        self.since = response['next_batch']
+        rooms = response.get('rooms', {})
+        for room_id in rooms.get('invite', {}):
+            await self._request('POST', f'/join/{self._quote(room_id)}', {})
+        for room_id, sync_room in rooms.get('join', {}).items():
+            room_raw = self.raw_rooms.get(room_id)
+            new_room = room_raw is None
+            if new_room:
+                room_raw = RawRoom(room_id)
+                room_raw.event_history_limit = self.history_window
+                self.raw_rooms[room_id] = room_raw
+                for event in sync_room.get('state', {}).get('events', []):
+                    room_raw._process_state_event(event)
+            events = sync_room.get('timeline', {}).get('events', [])
+            for event in events:
+                event['room_id'] = room_id
+                if 'state_key' in event:
+                    room_raw._process_state_event(event)
+                room_raw._put_event(event)
+            if (new_room or not dispatch) and not room_raw.guest_access and self._room2name(room_raw) not in self.rooms:
+                # MatrixRoom decodes the events already in room_raw into its history
+                self.rooms[self._room2name(room_raw)] = service_matrix.MatrixRoom(self, room_raw)
+            if dispatch:
+                for event in events:
+                    self.dispatcher.submit(self.handle_message, room_raw, event)
+        if not dispatch:
+            # saved rooms without new events weren't in the sync, but are rooms all the same
+            for room_raw in self.raw_rooms.values():
+                if not room_raw.guest_access and self._room2name(room_raw) not in self.rooms:
+                    self.rooms[self._room2name(room_raw)] = service_matrix.MatrixRoom(self, room_raw)
+        if self.sync_state is not None:
+            if dispatch:
+                self.dispatcher.submit(self.sync_state.end, self.since)
+                self.dispatcher.submit(self.sync_state.save, self.raw_rooms)
+            else:
+                self.sync_state.end(self.since)
@@ -1,5 +1,7 @@
 
-import logging
+import collections, json, logging, os, queue, threading, time
+
+import metrics
 
 logger = logging.getLogger(__name__)
 
@@ -10,30 +12,288 @@ logger = logging.getLogger(__name__)
 ##### Separating things this way is important when writing software.
 
 class Event:
-    def __init__(self, service, room, id, sender, type, data=None, raw=None, reply=None):
+    # events are created for everything a service receives, so they are kept small.
+    # if a decode function is given, data and reply are filled in from decode(raw) when first used.
+    __slots__ = ('service', 'room', 'id', 'sender', 'type', 'raw', '_data', '_reply', '_decode')
+    def __init__(self, service, room, id, sender, type, data=None, raw=None, reply=None, decode=None):
         self.service = service
         self.room = room
         self.id = id
         self.sender = sender
         self.type = type
-        self.data = data
         self.raw = raw
-        self.reply = reply
+        self._data = data
+        self._reply = reply
+        self._decode = decode
+    @property
+    def data(self):
+        if self._decode is not None:
+            self._decoded()
+        return self._data
+    @data.setter
+    def data(self, data):
+        if self._decode is not None:
+            self._decoded()
+        self._data = data
+    @property
+    def reply(self):
+        if self._decode is not None:
+            self._decoded()
+        return self._reply
+    @reply.setter
+    def reply(self, reply):
+        if self._decode is not None:
+            self._decoded()
+        self._reply = reply
+    def _decoded(self):
+        # _decode is only cleared once data and reply are set, as events are read from several threads.
+        # two threads may both decode an event, which gives the same result.
+        decode = self._decode
+        if decode is not None:
+            self._data, self._reply = decode(self.raw)
+            self._decode = None
+
+class History:
+    # the decoded events of a room in order, kept up to date as events arrive rather than rebuilt on access.
+    # only the newest `window` events are retained, and an index from event id to position makes resuming cheap.
+    # events are appended by the service while modules read from other threads, so trimming and reading hold a lock.
+    def __init__(self, window = 1024, events = []):
+        self.window = window
+        self.lock = threading.Lock()
+        self.events = []
+        self.start = 0 # position of the oldest retained event in self.events
+        self.offset = 0 # number of events dropped from self.events, for positions in the index
+        self.positions = {}
+        for event in events:
+            self.append(event)
+    def append(self, event):
+        if event.id in self.positions:
+            return
+        with self.lock:
+            self.positions[event.id] = self.offset + len(self.events)
+            self.events.append(event)
+            if len(self.events) - self.start > self.window:
+                del self.positions[self.events[self.start].id]
+                self.start += 1
+                if self.start > self.window:
+                    # compact occasionally so trimming stays cheap
+                    del self.events[:self.start]
+                    self.offset += self.start
+                    self.start = 0
+    def after(self, event_id):
+        # events newer than event_id, or all retained events if it isn't known
+        with self.lock:
+            position = self.positions.get(event_id)
+            if position is None:
+                return self.events[self.start:]
+            return self.events[position - self.offset + 1:]
+    def __contains__(self, event_id):
+        return event_id in self.positions
+    def __len__(self):
+        with self.lock:
+            return len(self.events) - self.start
+    def __iter__(self):
+        with self.lock:
+            return iter(self.events[self.start:])
+    def __getitem__(self, idx):
+        with self.lock:
+            if type(idx) is slice:
+                return self.events[self.start:][idx]
+            length = len(self.events) - self.start
+            if idx < 0:
+                idx += length
+            if not 0 <= idx < length:
+                raise IndexError('history index out of range')
+            return self.events[self.start + idx]
+
+class SyncState:
+    # a service's sync token, its rooms' names and the last confirmed event of each room, saved as json at path,
+    #  so a restart syncs only what came after and doesn't need the rooms' state or history again.
+    # the saved token lags the newest: it is the one before the oldest sync batch with a message that isn't confirmed yet,
+    #  so messages received but not processed when the bot stopped are delivered again, and confirmed ones are skipped by resume points.
+    # a message is confirmed once its handlers have run, unless a module deferred it to confirm itself after processing it later;
+    #  a room's messages are then only confirmed up to its oldest deferred one.
+    def __init__(self, path, user_id, interval = 1.0, max_batches = 1024):
+        self.path = path
+        self.user_id = user_id
+        self.interval = interval
+        self.max_batches = max_batches
+        self.lock = threading.Lock()
+        self.since = None
+        self.rooms = {} # room id: (name, guest_access)
+        self.resume = {} # room name: id of the last confirmed event
+        if os.path.exists(path):
+            with open(path) as file:
+                saved = json.load(file)
+            self.since = saved['since']
+            self.rooms = {room_id: tuple(room) for room_id, room in saved['rooms'].items()}
+            self.resume = saved['resume']
+        self.batches = collections.deque() # (token before the batch, {room name: (room, history position of its last message)})
+        self.current = None
+        self.confirmed = {} # room name: history position of the last confirmed event
+        self.deferred = {} # room name: history positions of messages modules will confirm, oldest first
+        self.handled_behind = {} # room name: (position, id) of the newest message handled behind a deferred one
+        self.saved_time = 0
+    def begin(self, since):
+        # called before the events of a sync batch are received
+        with self.lock:
+            self.current = (since, {})
+            self.since = since
+    def receive(self, event):
+        # called after event is appended to its room's history
+        position = event.room.history.positions.get(event.id)
+        with self.lock:
+            if self.resume.get(event.room.name) == event.id:
+                self.confirmed[event.room.name] = position
+            elif event.type == 'message' and event.sender != self.user_id and self.current is not None and position is not None:
+                self.current[1][event.room.name] = (event.room, position)
+    def end(self, next_batch):
+        # called once the batch's events are received
+        with self.lock:
+            self.batches.append(self.current)
+            self.current = None
+            self.since = next_batch
+            self._retire()
+    def defer(self, event):
+        # a module will confirm event once it has processed it, rather than it being confirmed when its handlers return
+        position = event.room.history.positions.get(event.id)
+        if position is None:
+            return
+        with self.lock:
+            self.deferred.setdefault(event.room.name, collections.deque()).append(position)
+    def handled(self, event):
+        # called once event's handlers have run
+        position = event.room.history.positions.get(event.id)
+        if position is None:
+            return
+        with self.lock:
+            deferred = self.deferred.get(event.room.name)
+            if not deferred:
+                self._confirm(event.room.name, position, event.id)
+            elif position not in deferred and position > self.handled_behind.get(event.room.name, (-1, None))[0]:
+                self.handled_behind[event.room.name] = (position, event.id)
+    def confirm(self, event):
+        # everything up to event in its room has been processed
+        position = event.room.history.positions.get(event.id)
+        with self.lock:
+            deferred = self.deferred.get(event.room.name)
+            while deferred and position is not None and deferred[0] <= position:
+                deferred.popleft()
+            self._confirm(event.room.name, position, event.id)
+            if not deferred:
+                self.deferred.pop(event.room.name, None)
+                handled = self.handled_behind.pop(event.room.name, None)
+                if handled is not None and position is not None and handled[0] > position:
+                    self._confirm(event.room.name, *handled)
+    def _confirm(self, room_name, position, event_id):
+        self.resume[room_name] = event_id
+        if position is not None:
+            self.confirmed[room_name] = max(position, self.confirmed.get(room_name, -1))
+        self._retire()
+    def save(self, raw_rooms, force = False):
+        # raw_rooms maps room ids to objects with name and guest_access, as the service's matrix library keeps them
+        if not force and time.monotonic() - self.saved_time < self.interval:
+            return
+        with self.lock:
+            self.saved_time = time.monotonic()
+            since = self.batches[0][0] if self.batches else self.current[0] if self.current is not None else self.since
+            saved = dict(since=since, resume=dict(self.resume), rooms=dict(self.rooms))
+        for room_id, room_raw in list(raw_rooms.items()):
+            saved['rooms'][room_id] = (room_raw.name, room_raw.guest_access)
+        with open(self.path + '.tmp', 'w') as file:
+            json.dump(saved, file)
+        os.replace(self.path + '.tmp', self.path)
+    def _retire(self):
+        while self.batches:
+            since, rooms = self.batches[0]
+            # messages that have left the room's history window can't be delivered again, so don't hold the token back
+            if len(self.batches) <= self.max_batches and any([
+                self.confirmed.get(name, -1) < position and position >= room.history.offset + room.history.start
+                for name, (room, position) in rooms.items()
+            ]):
+                break
+            self.batches.popleft()
 
 class Room:
-    def __init__(self, service, name, voice, members=[], history=[], raw=None):
+    def __init__(self, service, name, voice, members=[], history=None, raw=None):
         self.service = service
         self.name = name
         self.voice = voice
         self.members = members
-        self.history = history
+        self.history = History() if history is None else history
         self.raw = raw
     def send(self, message):
         return self.service.send(self, message)
 
+class Dispatcher:
+    # runs handler(item) on a pool of worker threads.
+    # items with the same key (a room) are handled one at a time in the order they were put,
+    # while different keys proceed in parallel, taking turns one item at a time.
+    # each key queues at most `bound` items, after which its oldest queued item is dropped and counted,
+    # as waiting in put() would stall the service's sync thread, and with it every other key.
+    def __init__(self, handler, workers = 4, bound = 256):
+        self.handler = handler
+        self.bound = bound
+        self.condition = threading.Condition()
+        self.queues = {} # present while a key has items queued or being handled
+        self.ready = queue.Queue()
+        self.stats = dict(handled=0, queued=0, dropped=0, latency_total=0.0, latency_max=0.0)
+        self.seconds = metrics.histogram('dispatch_handler_seconds', 'time spent handling each event')
+        self.drops = metrics.counter('dispatcher_dropped_total', 'events dropped unhandled from a full dispatch queue')
+        metrics.collect('dispatcher', self.stats)
+        self.workers = [threading.Thread(target=self._work, daemon=True) for idx in range(workers)]
+        for worker in self.workers:
+            worker.start()
+    def put(self, key, item):
+        with self.condition:
+            items = self.queues.get(key)
+            if items is None:
+                self.queues[key] = collections.deque([item])
+                self.ready.put(key)
+            else:
+                if len(items) >= self.bound:
+                    items.popleft()
+                    self.stats['dropped'] += 1
+                    self.stats['queued'] -= 1
+                    self.drops.inc()
+                    logger.warning(f'dropped the oldest queued event of {key}, as {self.bound} were queued')
+                items.append(item)
+            self.stats['queued'] += 1
+    def depth(self):
+        with self.condition:
+            return {key: len(items) for key, items in self.queues.items()}
+    def _work(self):
+        while True:
+            key = self.ready.get()
+            with self.condition:
+                item = self.queues[key].popleft()
+                self.stats['queued'] -= 1
+            start = time.monotonic()
+            try:
+                self.handler(item)
+            except Exception:
+                logger.exception(f'unhandled exception dispatching {key}')
+            latency = time.monotonic() - start
+            self.seconds.observe(latency)
+            with self.condition:
+                self.stats['handled'] += 1
+                self.stats['latency_total'] += latency
+                self.stats['latency_max'] = max(self.stats['latency_max'], latency)
+                if self.queues[key]:
+                    self.ready.put(key)
+                else:
+                    del self.queues[key]
+
 class Services:
-    def __init__(self):
+    # with metrics_port, counters, gauges and histograms are served there for prometheus.
+    # with trace, the stages of each message's handling are timed, and logged at debug level.
+    def __init__(self, metrics_port = None, trace = False):
         self.services = []
+        self.dispatcher = Dispatcher(self._handle_event)
+        self.events = metrics.counter('events_received_total', 'events received from services', ('type',))
+        metrics.tracer.enabled = trace
+        if metrics_port is not None:
+            metrics.serve(metrics_port)
     def wait(self):
         for service in self.services:
             service.wait()
@@ -43,17 +303,23 @@ class Services:
     def stop(self):
         for service in self.services:
             service.stop()
-    def add_matrix(self, username, password, server):
-        import service_matrix
-        self.add(service_matrix.Matrix(self, username, password, server))
+    def add_matrix(self, username, password, server, use_asyncio = False, resume = True):
+        # with resume, the sync token and rooms are kept in sync--username.json, so a restart only syncs what is new
+        sync_path = os.path.abspath(f'sync--{username}.json') if resume else None
+        if use_asyncio:
+            import service_matrix_async
+            self.add(service_matrix_async.AsyncMatrix(self, username, password, server, sync_path = sync_path))
+        else:
+            import service_matrix
+            self.add(service_matrix.Matrix(self, username, password, server, sync_path = sync_path))
 
     def on_member(self, event):
         self.on_message(event)
     def on_other(self, event):
         self.on_message(event)
     def on_message(self, event):
-        logger.debug(f'{event.service} {event.room} {event.id} {event.sender} {event.type} {event.data} reply={event.reply}')
-        pass
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f'{event.service} {event.room} {event.id} {event.sender} {event.type} {event.data} reply={event.reply}')
 
     def _on_error(self, event, exception):
         import traceback
@@ -63,8 +329,15 @@ class Services:
             logger.error(line)
         self.on_error(event, exception, exc_str)
     def _on_event(self, event):
+        # called by services as events arrive; handlers run on the dispatcher, in order per room
+        self.events.inc(type=event.type)
+        metrics.tracer.begin(event.id, 'dispatch', event.room.name)
+        self.dispatcher.put((event.service, event.room.name), event)
+    def _handle_event(self, event):
+        metrics.tracer.stage(event.id, 'handle')
         try:
-            self.log(event.service, event.room, event.sender, event.data or '<no data>')
+            if logger.isEnabledFor(logging.INFO):
+                self.log(event.service, event.room, event.sender, event.data or '<no data>')
             if type == 'message':
                 if event.sender != service.user_id:
                     self.on_message(event)
@@ -74,6 +347,9 @@ class Services:
                 self.on_other(event)
         except Exception as exception:
             self._on_error(event=event, exception=exception)
+        # the event is done with unless a module deferred it, so a restart doesn't deliver it again
+        if hasattr(event.service, 'handled'):
+            event.service.handled(event)
 
     def log(self, service, room, sender, text):
         log_lines = text.split('\n')
@@ -94,3 +370,125 @@ class TempMessage:
         self.room.service.delete(self.room, self.msg)
         self.msg = None
 
+class StreamingMessage:
+    # sends a message as soon as there is text for it, then edits it as more arrives.
+    # edits are limited to one per interval seconds; services without edit() get a single send at the end.
+    def __init__(self, room, interval = 1.0):
+        self.room = room
+        self.interval = interval
+        self.id = None
+        self.text = ''
+        self.sent_text = ''
+        self.sent_time = 0
+    def __enter__(self):
+        return self
+    def update(self, text):
+        self.text = text
+        if not hasattr(self.room.service, 'edit') or not text.strip():
+            return
+        if time.monotonic() - self.sent_time >= self.interval:
+            self._send()
+    def __exit__(self, *params):
+        self.close()
+    def close(self):
+        # sends the final text if it hasn't been yet
+        if self.text != self.sent_text or self.id is None:
+            self._send()
+    def _send(self):
+        if self.id is None:
+            self.id = self.room.service.send(self.room, self.text)
+        else:
+            self.room.service.edit(self.room, self.id, self.text)
+        self.sent_text = self.text
+        self.sent_time = time.monotonic()
+
+class Pending:
+    # stands in for the id of an event an Outbox has not sent yet
+    def __init__(self):
+        self.id = None
+
+class Outbox(threading.Thread):
+    # sends typing notices, reactions, redactions and read markers from a worker thread, so callers don't wait on the server.
+    # requests are coalesced while queued: typing refreshes are deduplicated per room, a reaction redacted before
+    # it was sent is never sent, and only the newest read marker per room is sent.
+    # the service provides blocking _typing, _react, _delete and _confirm methods that do the actual requests.
+    def __init__(self, service):
+        super().__init__(daemon=True)
+        self.service = service
+        self.condition = threading.Condition()
+        self.queue = collections.deque()
+        self.typing_sent = {}
+        self.stats = dict(queued=0, sent=0, saved=0, failed=0, pending=0)
+        metrics.collect('outbox', self.stats, user=getattr(service, 'user_id', ''))
+        self.start()
+    def typing(self, room, flag = True, timeout = None):
+        with self.condition:
+            for op in self.queue:
+                if op[0] == 'typing' and op[1].name == room.name:
+                    self.queue.remove(op)
+                    self.stats['saved'] += 1
+                    break
+            last_flag, last_timeout, last_time = self.typing_sent.get(room.name, (False, None, 0))
+            if flag == last_flag and (not flag or last_timeout is None or time.monotonic() - last_time < last_timeout / 2000):
+                # the server already shows this
+                self.stats['saved'] += 1
+                return
+            self._put('typing', room, flag, timeout)
+    def react(self, event, reaction):
+        pending = Pending()
+        with self.condition:
+            self._put('react', event, reaction, pending)
+        return pending
+    def delete(self, room, event_id):
+        if event_id is None:
+            return
+        with self.condition:
+            if type(event_id) is Pending:
+                for op in self.queue:
+                    if op[0] == 'react' and op[3] is event_id:
+                        self.queue.remove(op)
+                        self.stats['saved'] += 2
+                        self.stats['pending'] = len(self.queue)
+                        return
+            self._put('delete', room, event_id)
+    def confirm(self, event):
+        with self.condition:
+            for op in self.queue:
+                if op[0] == 'confirm' and op[1].room.name == event.room.name:
+                    self.queue.remove(op)
+                    self.stats['saved'] += 1
+                    break
+            self._put('confirm', event)
+    def _put(self, *op):
+        self.queue.append(op)
+        self.stats['queued'] += 1
+        self.stats['pending'] = len(self.queue)
+        self.condition.notify()
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.queue:
+                    self.condition.wait()
+                op = self.queue.popleft()
+                self.stats['pending'] = len(self.queue)
+                if op[0] == 'typing':
+                    self.typing_sent[op[1].name] = (op[2], op[3], time.monotonic())
+            kind, params = op[0], op[1:]
+            try:
+                if kind == 'typing':
+                    self.service._typing(*params)
+                elif kind == 'react':
+                    event, reaction, pending = params
+                    pending.id = self.service._react(event, reaction)
+                elif kind == 'delete':
+                    room, event_id = params
+                    if type(event_id) is Pending:
+                        event_id = event_id.id
+                    if event_id is not None:
+                        self.service._delete(room, event_id)
+                elif kind == 'confirm':
+                    self.service._confirm(*params)
+                self.stats['sent'] += 1
+            except Exception:
+                self.stats['failed'] += 1
+                logger.exception(f'{self.service} {kind} failed')
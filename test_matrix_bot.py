@@ -13,12 +13,12 @@ from module_rwkv import RWKV
 import logging
 
 class Bot(Services):
-    def __init__(self, username='test_matrix_bot', password='test_matrix_bot', homeserver='https://matrix.org'):
-        super().__init__()
-        self.add_matrix(username, password, homeserver)
+    def __init__(self, username='test_matrix_bot', password='test_matrix_bot', homeserver='https://matrix.org', use_asyncio=False, metrics_port=None, trace=False, **rwkv_params):
+        super().__init__(metrics_port, trace)
+        self.add_matrix(username, password, homeserver, use_asyncio)
         self.modules = []
         self.modules.append(Commands(self))
-        self.modules.append(RWKV(self))
+        self.modules.append(RWKV(self, **rwkv_params))
 
     def __enter__(self):
         for module in self.modules:
@@ -42,5 +42,5 @@ class Bot(Services):
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.DEBUG)
-    with Bot() as bot:
+    with Bot(metrics_port=9100) as bot:
         bot.wait()